@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Gentoo Mirror Analyzer Benchmark
+Runs the mirror analyzer against local fake mirrors on loopback and reports
+wall time, requests issued and whether the expected mirror won
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import modules
+
+# Color codes for terminal output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    CYAN = '\033[96m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+def print_success(msg):
+    print(f"{Colors.GREEN}✓ {msg}{Colors.RESET}")
+
+def print_error(msg):
+    print(f"{Colors.RED}✗ ERROR: {msg}{Colors.RESET}")
+
+def print_warning(msg):
+    print(f"{Colors.YELLOW}⚠ WARNING: {msg}{Colors.RESET}")
+
+def print_info(msg):
+    print(f"{Colors.CYAN}ℹ {msg}{Colors.RESET}")
+
+def print_header(msg):
+    print(f"\n{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{msg}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}\n")
+
+def print_separator():
+    print(f"{Colors.CYAN}{'-'*70}{Colors.RESET}")
+
+# Default scenario: a clear winner, close runners-up, a bandwidth-starved
+# low-latency mirror, a mirror that rejects HEAD, and two black holes
+DEFAULT_SCENARIO = [
+    {"name": "fast", "latency_ms": 15, "jitter_ms": 2, "bandwidth_kbps": 20000},
+    {"name": "close-second", "latency_ms": 20, "jitter_ms": 4, "bandwidth_kbps": 12000},
+    {"name": "starved", "latency_ms": 5, "jitter_ms": 1, "bandwidth_kbps": 200},
+    {"name": "medium", "latency_ms": 40, "jitter_ms": 10, "bandwidth_kbps": 10000},
+    {"name": "jittery", "latency_ms": 30, "jitter_ms": 25, "bandwidth_kbps": 10000},
+    {"name": "slow", "latency_ms": 120, "jitter_ms": 20, "bandwidth_kbps": 5000},
+    {"name": "no-head", "latency_ms": 15, "jitter_ms": 2, "bandwidth_kbps": 10000, "head_allowed": False},
+    {"name": "blackhole-1", "blackhole": True},
+    {"name": "blackhole-2", "blackhole": True},
+]
+
+# The fake large file repeats a random block of prime length, so bytes written
+# at the wrong offset by a downloader are detectable
+_FAKE_BLOCK = random.Random(0).randbytes(65521)
+
+def fake_file_bytes(offset, length):
+    """Return length bytes of the fake large file starting at offset."""
+    start = offset % len(_FAKE_BLOCK)
+    repeats = (start + length) // len(_FAKE_BLOCK) + 1
+    return (_FAKE_BLOCK * repeats)[start:start + length]
+
+class FakeMirrorHandler(BaseHTTPRequestHandler):
+    """Serves HEAD/GET with the latency, jitter and bandwidth of its server's profile."""
+    protocol_version = "HTTP/1.1"
+
+    def _delay(self):
+        profile = self.server.profile
+        with self.server.lock:
+            self.server.requests += 1
+        latency = profile.get("latency_ms", 0) + random.uniform(-1, 1) * profile.get("jitter_ms", 0)
+        time.sleep(max(0, latency) / 1000)
+
+    def do_HEAD(self):
+        self._delay()
+        if not self.server.profile.get("head_allowed", True):
+            self.send_response(405)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.path == "/":
+            self.send_header("Content-Length", "0")
+        else:
+            self.send_header("Content-Length", str(self.server.file_size))
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        self._delay()
+        if self.path == "/":
+            body = b"<html>fake gentoo mirror</html>"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # Any other path is a large file, streamed at the configured bandwidth
+        size = self.server.file_size
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first or 0)
+            size = min(size, int(last) + 1) - start if last else size - start
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+        bytes_per_second = self.server.profile.get("bandwidth_kbps", 10000) * 1024
+        sent = 0
+        try:
+            while sent < size:
+                piece = fake_file_bytes(start + sent, min(16384, size - sent))
+                self.wfile.write(piece)
+                sent += len(piece)
+                time.sleep(len(piece) / bytes_per_second)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeMirror:
+    """One loopback fake mirror: an HTTP server, or a socket that never answers."""
+
+    def __init__(self, profile, file_size):
+        self.profile = profile
+        if profile.get("blackhole"):
+            # Connections complete in the kernel backlog but are never accepted
+            self.server = None
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.bind(("127.0.0.1", 0))
+            self.socket.listen(128)
+            self.port = self.socket.getsockname()[1]
+        else:
+            self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeMirrorHandler)
+            self.server.daemon_threads = True
+            self.server.profile = profile
+            self.server.file_size = file_size
+            self.server.requests = 0
+            self.server.lock = threading.Lock()
+            self.port = self.server.server_port
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.port}/"
+
+    @property
+    def requests(self):
+        return self.server.requests if self.server else 0
+
+    def reset(self):
+        if self.server:
+            with self.server.lock:
+                self.server.requests = 0
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        else:
+            self.socket.close()
+
+def expected_winner(scenario, settings):
+    """Return the name of the mirror the analyzer should pick for the scenario."""
+    candidates = [p for p in scenario if not p.get("blackhole") and p.get("head_allowed", True)]
+    if settings.get("MIRROR_RANKING") == "throughput":
+        # Highest bandwidth wins, latency breaks ties
+        return min(candidates, key=lambda p: (-p.get("bandwidth_kbps", 10000), p.get("latency_ms", 0)))["name"]
+    return min(candidates, key=lambda p: p.get("latency_ms", 0))["name"]
+
+def run_benchmark(scenario, runs, settings, file_size):
+    """Run the analyzer against the scenario and return one report per run."""
+    mirrors = [FakeMirror(profile, file_size) for profile in scenario]
+    by_url = {m.url: m for m in mirrors}
+    winner = expected_winner(scenario, settings)
+    reports = []
+    saved_paths = (modules.CONFIG_FILE, modules.MIRROR_CACHE_FILE)
+    try:
+        with tempfile.TemporaryDirectory(prefix="mirror-bench-") as workdir:
+            # Point the analyzer at a throwaway config, cache and mirror list
+            mirror_list = os.path.join(workdir, "mirrors.json")
+            with open(mirror_list, "w") as f:
+                json.dump([{"url": m.url, "name": m.profile["name"], "country": "RO",
+                            "protocol": "http", "ipv6": False} for m in mirrors], f)
+            config = dict(modules.DEFAULT_CONFIG)
+            config.update({"MIRROR_LIST_FILE": mirror_list, "MIRROR_GEO_PREFILTER": False})
+            config.update(settings)
+            modules.CONFIG_FILE = os.path.join(workdir, "config.jsonc")
+            modules.MIRROR_CACHE_FILE = os.path.join(workdir, "mirror_cache.json")
+            with open(modules.CONFIG_FILE, "w") as f:
+                json.dump(config, f)
+
+            for run in range(1, runs + 1):
+                for m in mirrors:
+                    m.reset()
+                if os.path.exists(modules.MIRROR_CACHE_FILE):
+                    os.remove(modules.MIRROR_CACHE_FILE)
+
+                start = time.perf_counter()
+                mirror_urls = modules.analyze_and_select_best_mirror() or []
+                wall_time = time.perf_counter() - start
+
+                # Validating the chosen mirror should be nearly free once the cache is warm
+                modules.cfg_set("MIRROR", mirror_urls[0] if mirror_urls else "")
+                start = time.perf_counter()
+                modules.validate_and_set_mirror()
+                validate_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for m in mirrors:
+                    modules.check_mirror_reachable(m.url, timeout=2)
+                reachable_time = time.perf_counter() - start
+
+                selected = [by_url[url].profile["name"] for url in mirror_urls if url in by_url]
+                reports.append({
+                    "run": run,
+                    "timestamp": time.time(),
+                    "settings": settings,
+                    "mirrors": len(mirrors),
+                    "analyzer_seconds": round(wall_time, 3),
+                    "validate_seconds": round(validate_time, 3),
+                    "reachable_seconds": round(reachable_time, 3),
+                    "requests": sum(m.requests for m in mirrors),
+                    "expected_winner": winner,
+                    "selected": selected,
+                    "correct": bool(selected) and selected[0] == winner
+                })
+    finally:
+        modules.CONFIG_FILE, modules.MIRROR_CACHE_FILE = saved_paths
+        modules.close_mirror_sessions()
+        for m in mirrors:
+            m.close()
+    return reports
+
+def main():
+    """Parse arguments, run the benchmark and print/store the results."""
+    parser = argparse.ArgumentParser(description="Benchmark the mirror analyzer against local fake mirrors")
+    parser.add_argument("--scenario", help="JSON file with a list of mirror profiles (default: built-in scenario)")
+    parser.add_argument("--runs", type=int, default=3, help="number of analyzer runs (default: 3)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a config value for the analyzer, e.g. MIRROR_SAMPLING=tournament")
+    parser.add_argument("--file-size", type=int, default=8 * 1024 * 1024,
+                        help="size in bytes of the fake large file served for throughput tests")
+    parser.add_argument("--output", default="bench_output.txt",
+                        help="file to append JSON result lines to (default: bench_output.txt)")
+    args = parser.parse_args()
+
+    scenario = DEFAULT_SCENARIO
+    if args.scenario:
+        with open(args.scenario, encoding="utf-8") as f:
+            scenario = json.load(f)
+
+    settings = {}
+    for item in args.set:
+        key, _, value = item.partition("=")
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+
+    print_header("GENTOO MIRROR ANALYZER BENCHMARK")
+    print_info(f"Fake mirrors: {len(scenario)} | Runs: {args.runs} | Settings: {settings or 'defaults'}")
+    print_separator()
+
+    # Keep the analyzer's own output out of the report
+    with open(os.devnull, "w") as devnull:
+        real_stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            reports = run_benchmark(scenario, args.runs, settings, args.file_size)
+        finally:
+            sys.stdout = real_stdout
+
+    for report in reports:
+        status = print_success if report["correct"] else print_error
+        status(f"Run {report['run']}: analyzer {report['analyzer_seconds']:.2f}s, "
+               f"{report['requests']} requests, selected {report['selected']} "
+               f"(expected {report['expected_winner']})")
+        print(f"   validate_and_set_mirror: {report['validate_seconds']:.3f}s | "
+              f"check_mirror_reachable (all): {report['reachable_seconds']:.2f}s")
+    print_separator()
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for report in reports:
+                f.write(json.dumps(report) + "\n")
+        print_info(f"Results appended to {args.output}")
+
+    if not all(report["correct"] for report in reports):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
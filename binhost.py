@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Gentoo Binary Package Host
+Serves a builder's binary packages (PKGDIR with its Packages index) over HTTP
+so follower installs can emerge them instead of compiling
+"""
+
+import argparse
+import functools
+import os
+import re
+import shutil
+import sys
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+# Color codes for terminal output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    CYAN = '\033[96m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+def print_success(msg):
+    print(f"{Colors.GREEN}✓ {msg}{Colors.RESET}")
+
+def print_error(msg):
+    print(f"{Colors.RED}✗ ERROR: {msg}{Colors.RESET}")
+
+def print_warning(msg):
+    print(f"{Colors.YELLOW}⚠ WARNING: {msg}{Colors.RESET}")
+
+def print_info(msg):
+    print(f"{Colors.CYAN}ℹ {msg}{Colors.RESET}")
+
+def print_header(msg):
+    print(f"\n{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{msg}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}\n")
+
+def print_separator():
+    print(f"{Colors.CYAN}{'-'*70}{Colors.RESET}")
+
+class BinhostHandler(SimpleHTTPRequestHandler):
+    """Serves HEAD/GET of files under the package directory, without directory listings."""
+    protocol_version = "HTTP/1.1"
+
+    def list_directory(self, path):
+        self.send_error(404)
+        return None
+
+    def send_head(self):
+        # Portage resumes interrupted package downloads with a single byte range
+        self.range_length = None
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        f = open(path, "rb")
+        size = os.fstat(f.fileno()).st_size
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        if start > end:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        f.seek(start)
+        self.range_length = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        if self.range_length is None:
+            shutil.copyfileobj(source, outputfile)
+            return
+        remaining = self.range_length
+        while remaining > 0:
+            data = source.read(min(remaining, 1024 * 1024))
+            if not data:
+                break
+            outputfile.write(data)
+            remaining -= len(data)
+
+    def log_message(self, format, *args):
+        print(f"{Colors.CYAN}   {self.client_address[0]} {format % args}{Colors.RESET}")
+
+def make_server(pkgdir, port, address="0.0.0.0"):
+    """Create (but don't start) a binhost server for pkgdir; returns the ThreadingHTTPServer."""
+    handler = functools.partial(BinhostHandler, directory=pkgdir)
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    """Run the binhost server until interrupted."""
+    parser = argparse.ArgumentParser(description="Serve binary packages to follower installs")
+    parser.add_argument("--dir", default="/var/cache/binpkgs",
+                        help="package directory containing the Packages index (default: /var/cache/binpkgs)")
+    parser.add_argument("--port", type=int, default=8081, help="port to listen on (default: 8081)")
+    parser.add_argument("--address", default="0.0.0.0", help="address to listen on (default: all)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(os.path.join(args.dir, "Packages")):
+        print_error(f"No Packages index in {args.dir}; run 'emaint binhost --fix' on the builder first")
+        sys.exit(1)
+    server = make_server(args.dir, args.port, args.address)
+    print_header("GENTOO BINARY PACKAGE HOST")
+    print_info(f"Package directory: {args.dir}")
+    print_success(f"Listening on {args.address}:{args.port}")
+    print_info(f'Set "BINPKG_MODE": "follower" and "BINHOST": "http://<this-host>:{args.port}/" '
+               "in each installer's config.jsonc")
+    print_separator()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print_info("Shutting down")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import sys
 from modules import *
 
 # Color codes for terminal output
@@ -41,6 +42,13 @@ ZONEINFO = cfg_get("ZONEINFO")
 # LOCALE will be set after locale-gen in CRITICALS()
 RPSW = cfg_get("ROOT_PASSWORD")
 UPSW = cfg_get("USER_PASSWORD")
+# Deploying a golden image only re-runs the per-host steps
+GOLDEN_DEPLOY = cfg_get("GOLDEN_DEPLOY", "")
+# main.py makes an offline bundle available here when OFFLINE_BUNDLE is set
+BUNDLE_DIR = BUNDLE_CHROOT_PATH if cfg_get("OFFLINE_BUNDLE", "") else None
+# Fleet builds: a builder packages what it compiles, followers install those packages
+BINPKG_MODE = cfg_get("BINPKG_MODE", "").lower()
+BINHOST = cfg_get("BINHOST", "")
 
 hosts = f"""
 # /etc/hosts: Local Host Database
@@ -83,218 +91,7 @@ hosts = f"""
 #
 """
 
-
-def CRITICALS():
-    print_header("GENTOO INSTALLATION - CHROOT ENVIRONMENT")
-    print_info("Starting installation process inside chroot environment...")
-    print_separator()
-    
-    print_header("MOUNTING EFI PARTITION")
-    print_info("Creating /boot/efi directory...")
-    os.system("mkdir -p /boot/efi")
-    # Check if EFI partition is already mounted, if not mount it
-    if not os.path.ismount("/boot/efi"):
-        print_info(f"Mounting EFI partition {EFIPT} to /boot/efi...")
-        mount_result = os.system(f"mount -t vfat {EFIPT} /boot/efi")
-        if mount_result != 0:
-            print_warning(f"Failed to mount {EFIPT} to /boot/efi, continuing anyway...")
-        else:
-            print_success(f"EFI partition {EFIPT} mounted to /boot/efi")
-    else:
-        print_success("/boot/efi is already mounted")
-    print_separator()
-    
-    print_header("PORTAGE TREE SYNC")
-    print_info("Synchronizing Portage tree with emerge-webrsync...")
-    print_info("This downloads the Gentoo package database and may take several minutes...")
-    os.system("emerge-webrsync")
-    print_success("Portage tree synchronized successfully")
-    print_separator()
-    
-    print_header("MIRROR VALIDATION AND CONFIGURATION")
-    print_info("Validating and configuring Gentoo mirror for package downloads...")
-    print_separator()
-    
-    # Validate and set mirror using the analyzer
-    mirror_url = validate_and_set_mirror()
-    
-    if not mirror_url:
-        print_error("Failed to configure a valid mirror. Installation cannot continue.")
-        print_error("Please check your network connection and try again.")
-        os.system("exit 1")
-        return
-    
-    # Configure GENTOO_MIRRORS in make.conf
-    print_info(f"Configuring GENTOO_MIRRORS in /etc/portage/make.conf...")
-    print_info(f"Setting mirror to: {mirror_url}")
-    
-    # Check if GENTOO_MIRRORS already exists in make.conf
-    make_conf_path = "/etc/portage/make.conf"
-    mirror_line = f'GENTOO_MIRRORS="{mirror_url}"\n'
-    
-    try:
-        # Read existing make.conf
-        with open(make_conf_path, "r") as f:
-            lines = f.readlines()
-        
-        # Remove any existing GENTOO_MIRRORS lines
-        lines = [line for line in lines if not line.strip().startswith("GENTOO_MIRRORS=")]
-        
-        # Add the new GENTOO_MIRRORS line
-        lines.append(mirror_line)
-        
-        # Write back to make.conf
-        with open(make_conf_path, "w") as f:
-            f.writelines(lines)
-        
-        print_success(f"GENTOO_MIRRORS configured: {mirror_url}")
-        print_separator()
-    except Exception as e:
-        print_warning(f"Could not write to make.conf directly: {e}")
-        print_info("Using echo to append GENTOO_MIRRORS...")
-        os.system(f'echo \'GENTOO_MIRRORS="{mirror_url}"\' >> {make_conf_path}')
-        print_success(f"GENTOO_MIRRORS configured: {mirror_url}")
-        print_separator()
-    
-    print_info("Resyncing Portage tree with selected mirrors...")
-    os.system("emerge --sync --quiet")
-    print_success("Portage tree resynced with optimized mirrors")
-    print_separator()
-    
-    print_header("PROFILE SELECTION")
-    print_info(f"Setting Gentoo profile to profile number: {PROFILENR}")
-    os.system(f"eselect profile set {PROFILENR}")
-    print_success(f"Profile set to {PROFILENR}")
-    print_separator()
-    
-    print_header("SYSTEM UPGRADE")
-    print_info("Upgrading system packages to latest versions...")
-    print_info("This process may take a significant amount of time depending on system specifications...")
-    # Ensure read-write before long operation
-    os.system("mount -o remount,rw / 2>/dev/null; sync")
-    os.system("emerge --verbose --update --deep --changed-use @world")
-    # Check and fix after long operation
-    os.system("mount -o remount,rw / 2>/dev/null; sync")
-    print_success("System upgrade completed")
-    print_separator()
-    
-    print_header("TIMEZONE CONFIGURATION")
-    print_info(f"Setting timezone to: {ZONEINFO}")
-    os.system(f"ln -sf ../usr/share/zoneinfo/{ZONEINFO} /etc/localtime")
-    print_success(f"Timezone configured: {ZONEINFO}")
-    print_separator()
-    
-    print_header("LOCALE CONFIGURATION")
-    print_info("Generating locale configuration...")
-    print_info("Adding en_US.UTF-8 to locale.gen...")
-    os.system("""echo "en_US.UTF-8 UTF-8" > /etc/locale.gen""")
-    print_info("Generating locales...")
-    os.system("locale-gen")
-    print_success("Locales generated successfully")
-    # Now detect and set locale after it's been generated
-    print_info("Detecting and setting system locale...")
-    LOCALE = detect_and_set_locale()
-    print_info(f"Setting locale to option {LOCALE}...")
-    os.system(f"eselect locale set {LOCALE}")
-    print_success(f"Locale configured: option {LOCALE}")
-    print_info("Updating environment with new locale settings...")
-    os.system("env-update")
-    os.system("source /etc/profile")  
-    print_success("Environment updated with locale settings")
-    print_separator()  
-    print_header("FIRMWARE INSTALLATION")
-    print_info("Configuring firmware license acceptance...")
-    os.system("""
-    echo "sys-kernel/linux-firmware @BINARY-REDISTRIBUTABLE" >> /etc/portage/package.license
-    """)
-    os.system("""
-    echo "sys-firmware/intel-microcode intel-ucode" >> /etc/portage/package.license
-    """)
-    print_success("Firmware licenses configured")
-    
-    print_info("Installing Linux firmware packages...")
-    os.system("emerge sys-kernel/linux-firmware")    
-    print_success("Linux firmware installed")
-    
-    print_info("Installing SOF (Sound Open Firmware)...")
-    os.system("emerge sys-firmware/sof-firmware")
-    print_success("SOF firmware installed")
-    
-    print_info("Installing Intel microcode...")
-    os.system("emerge sys-firmware/intel-microcode")
-    print_success("Intel microcode installed")
-    print_separator()
-    
-    print_header("KERNEL INSTALLATION")
-    print_info("Configuring installkernel package use flags...")
-    os.system("""
-    echo "sys-kernel/installkernel systemd dracut grub" >> /etc/portage/package.use/installkernel
-    """)
-    print_success("Installkernel use flags configured")
-    
-    print_info("Installing Gentoo binary kernel...")
-    print_info("This may take several minutes...")
-    os.system("mount -o remount,rw / 2>/dev/null; sync")
-    os.system("emerge sys-kernel/gentoo-kernel-bin")
-    os.system("mount -o remount,rw / 2>/dev/null; sync")
-    print_success("Kernel installed successfully")
-    print_separator()
-    
-    print_header("BUILD TOOLS INSTALLATION")
-    print_info("Installing git and make for build tools...")
-    os.system("emerge dev-vcs/git sys-devel/make")
-    print_success("Build tools installed")
-    print_separator()
-    
-    print_header("FSTAB GENERATION")
-    print_info("Cloning cfstabgen from Codeberg...")
-    os.system("git clone https://codeberg.org/coast/cfstabgen.git")
-    print_success("cfstabgen repository cloned")
-    
-    print_info("Building and installing cfstabgen...")
-    os.system("cd cfstabgen && make && make install") 
-    print_success("cfstabgen installed")
-    
-    print_info("Generating /etc/fstab with UUIDs...")
-    os.system("cfstabgen -U / > /etc/fstab")
-    print_success("/etc/fstab generated successfully")
-    print_separator()
-    
-    print_header("NETWORK CONFIGURATION")
-    print_info(f"Setting system hostname to: {HOSTNAME}")
-    os.system(f"echo {HOSTNAME} > /etc/hostname")
-    print_success(f"Hostname set: {HOSTNAME}")
-    
-    print_info("Installing dhcpcd for network configuration...")
-    os.system("emerge net-misc/dhcpcd")
-    print_success("dhcpcd installed")
-    
-    print_info("Enabling dhcpcd service for automatic network configuration...")
-    os.system("systemctl enable dhcpcd")
-    print_success("dhcpcd service enabled")
-    
-    print_info(f"Configuring /etc/hosts with hostname: {HOSTNAME}")
-    with open("/etc/hosts", "w") as f: 
-        f.write(hosts)
-    print_success(f"/etc/hosts configured with hostname: {HOSTNAME}")
-    print_separator()
-    
-    print_header("USER ACCOUNT CONFIGURATION")
-    print_info("Setting root user password...")
-    apply_password("root", RPSW)
-    print_success("Root password has been set successfully")
-    
-    print_info(f"Creating user account: {USERNAME}")
-    print_info(f"Adding user to groups: users, wheel, audio, video")
-    os.system(f"useradd -m -G users,wheel,audio,video -s /bin/bash {USERNAME}")
-    print_success(f"User account {USERNAME} created")
-    
-    print_info(f"Setting password for user: {USERNAME}")
-    apply_password(USERNAME, UPSW)
-    print_success(f"Password for {USERNAME} has been set successfully")
-    print_separator()
-
-    sudo_config = """
+SUDO_CONFIG = """
     ## sudoers file.
     ##
     ## This file MUST be edited with the 'visudo' command as root.
@@ -441,39 +238,77 @@ def CRITICALS():
     ## Read drop-in files from /etc/sudoers.d
     @includedir /etc/sudoers.d
     """
-    print_header("SUDO CONFIGURATION")
-    def CONFIGURE_SUDOERS():
-        print_info("Installing sudo package...")
-        os.system("emerge -q sudo")
-        print_success("sudo installed")
-
-        print_info("Writing custom sudoers configuration...")
-        with open("/etc/sudoers", "w") as f:
-            f.write(sudo_config)
-        print_success("Custom sudoers configuration written")
-    CONFIGURE_SUDOERS()
+
+def emerge(args):
+    """Run emerge with args, keeping / read-write around it. Returns True on success."""
+    os.system("mount -o remount,rw / 2>/dev/null; sync")
+    result = os.system(f"emerge {args}")
+    os.system("mount -o remount,rw / 2>/dev/null; sync")
+    if result != 0:
+        print_error(f"emerge {args} failed")
+    return result == 0
+
+def MOUNT_EFI():
+    """Mount EFIPT at /boot/efi unless it is already mounted."""
+    print_header("MOUNTING EFI PARTITION")
+    print_info("Creating /boot/efi directory...")
+    os.system("mkdir -p /boot/efi")
+    # Check if EFI partition is already mounted, if not mount it
+    if not os.path.ismount("/boot/efi"):
+        print_info(f"Mounting EFI partition {EFIPT} to /boot/efi...")
+        mount_result = os.system(f"mount -t vfat {EFIPT} /boot/efi")
+        if mount_result != 0:
+            print_warning(f"Failed to mount {EFIPT} to /boot/efi, continuing anyway...")
+        else:
+            print_success(f"EFI partition {EFIPT} mounted to /boot/efi")
+    else:
+        print_success("/boot/efi is already mounted")
     print_separator()
+
+def WRITE_FSTAB():
+    """Generate /etc/fstab from this machine's partition UUIDs. Returns True on success."""
+    print_info("Generating /etc/fstab with UUIDs...")
+    if os.system("cfstabgen -U / > /etc/fstab") != 0:
+        print_error("cfstabgen failed to generate /etc/fstab")
+        return False
+    print_success("/etc/fstab generated successfully")
+    return True
+
+def CONFIGURE_HOSTNAME():
+    """Write /etc/hostname and /etc/hosts for HOSTNAME. Returns True."""
+    print_info(f"Setting system hostname to: {HOSTNAME}")
+    os.system(f"echo {HOSTNAME} > /etc/hostname")
+    print_success(f"Hostname set: {HOSTNAME}")
     
-    print_header("WIRELESS TOOLS INSTALLATION")
-    print_info("Installing wireless networking tools (iw, wpa_supplicant)...")
-    os.system("emerge net-wireless/iw net-wireless/wpa_supplicant")
-    print_success("Wireless tools installed")
-    print_separator()
+    print_info(f"Configuring /etc/hosts with hostname: {HOSTNAME}")
+    with open("/etc/hosts", "w") as f: 
+        f.write(hosts)
+    print_success(f"/etc/hosts configured with hostname: {HOSTNAME}")
+    return True
+
+def CONFIGURE_USERS():
+    """Set the root password and create USERNAME with its password. Returns True on success."""
+    print_info("Setting root user password...")
+    apply_password("root", RPSW)
+    print_success("Root password has been set successfully")
     
-    print_header("GRUB BOOTLOADER INSTALLATION")
-    print_info("Configuring GRUB for EFI-64 platform...")
-    os.system("""
-    echo 'GRUB_PLATFORMS="efi-64"' >> /etc/portage/make.conf
-    """)
-    print_success("GRUB platform configured")
-    
-    print_info("Installing GRUB bootloader...")
-    print_info("This may take several minutes...")
-    os.system("mount -o remount,rw / 2>/dev/null; sync")
-    os.system("emerge --verbose sys-boot/grub")
-    os.system("mount -o remount,rw / 2>/dev/null; sync")
-    print_success("GRUB installed successfully")
+    if os.system(f"id -u {USERNAME} >/dev/null 2>&1") == 0:
+        print_success(f"User account {USERNAME} already exists")
+    else:
+        print_info(f"Creating user account: {USERNAME}")
+        print_info(f"Adding user to groups: users, wheel, audio, video")
+        if os.system(f"useradd -m -G users,wheel,audio,video -s /bin/bash {USERNAME}") != 0:
+            print_error(f"Failed to create user account {USERNAME}")
+            return False
+        print_success(f"User account {USERNAME} created")
     
+    print_info(f"Setting password for user: {USERNAME}")
+    apply_password(USERNAME, UPSW)
+    print_success(f"Password for {USERNAME} has been set successfully")
+    return True
+
+def INSTALL_GRUB_EFI():
+    """Install GRUB to the EFI partition and generate its configuration. Returns True on success."""
     # Ensure EFI partition is mounted (it should already be from earlier)
     print_info("Verifying EFI partition mount...")
     if not os.path.ismount("/boot/efi"):
@@ -487,7 +322,9 @@ def CRITICALS():
         print_success("/boot/efi is already mounted")
     
     print_info("Installing GRUB to EFI directory...")
-    os.system("grub-install --efi-directory=/boot/efi")
+    if os.system("grub-install --efi-directory=/boot/efi") != 0:
+        print_error("grub-install failed")
+        return False
     print_success("GRUB installed to EFI directory")
     
     print_info("Creating GRUB configuration directory...")
@@ -495,8 +332,421 @@ def CRITICALS():
     print_success("GRUB configuration directory created")
     
     print_info("Generating GRUB configuration file...")
-    os.system("grub-mkconfig -o /boot/efi/grub/grub.cfg")
+    if os.system("grub-mkconfig -o /boot/efi/grub/grub.cfg") != 0:
+        print_error("grub-mkconfig failed")
+        return False
     print_success("GRUB configuration generated")
+    return True
+
+def DEPLOY_HOST_SETUP():
+    """Per-host configuration of a root deployed from a golden image."""
+    print_header("GOLDEN IMAGE DEPLOY - CHROOT ENVIRONMENT")
+    print_info("Root filesystem came from a golden image, running per-host steps only...")
+    print_separator()
+    
+    MOUNT_EFI()
+    
+    print_header("HOST IDENTITY")
+    # The image was captured without these so no two machines share them
+    print_info("Generating a new machine-id and SSH host keys...")
+    os.system("command -v systemd-machine-id-setup >/dev/null && systemd-machine-id-setup")
+    os.system("command -v ssh-keygen >/dev/null && ssh-keygen -A")
+    print_success("Machine identity generated")
+    
+    print_info(f"Setting timezone to: {ZONEINFO}")
+    os.system(f"ln -sf ../usr/share/zoneinfo/{ZONEINFO} /etc/localtime")
+    print_success(f"Timezone configured: {ZONEINFO}")
+    CONFIGURE_HOSTNAME()
+    failed = []
+    if not WRITE_FSTAB():
+        failed.append("fstab")
+    print_separator()
+    
+    print_header("USER ACCOUNT CONFIGURATION")
+    if not CONFIGURE_USERS():
+        failed.append("users")
+    print_separator()
+    
+    print_header("GRUB BOOTLOADER INSTALLATION")
+    if not INSTALL_GRUB_EFI():
+        failed.append("bootloader")
+    print_separator()
+    
+    print_info("Synchronizing all filesystem writes...")
+    os.system("sync")
+    # A root without fstab or a bootloader can't boot; don't report it as finished
+    if failed:
+        print_error(f"Failed steps: {', '.join(failed)}")
+        print_error("Fix the problem and re-run main.py to deploy the image again.")
+        sys.exit(1)
+    print_header("INSTALLATION COMPLETE")
+    print_success("Golden image deployed and configured for this host!")
+    print_success("Installation finished. You may now reboot your system!")
+    print_separator()
+
+def OFFLINE_SETUP():
+    """Install the Portage tree and distfiles from the offline bundle instead of the network. Returns True on success."""
+    manifest = load_bundle_manifest(BUNDLE_DIR)
+    print_header("PORTAGE TREE FROM OFFLINE BUNDLE")
+    print_info(f"Unpacking repository snapshot {manifest['snapshot']['filename']}...")
+    if not install_bundle_snapshot(BUNDLE_DIR, manifest):
+        print_error("Failed to unpack the repository snapshot from the offline bundle.")
+        return False
+    print_success("Portage tree installed from offline bundle")
+    
+    print_info("Copying distfiles from offline bundle...")
+    copied = install_bundle_distfiles(BUNDLE_DIR, manifest)
+    print_success(f"{copied} distfiles copied to /var/cache/distfiles")
+    print_separator()
+    return True
+
+def SYNC_PORTAGE_TREE():
+    """Fetch the Portage tree snapshot with emerge-webrsync. Returns True on success."""
+    lan_cache = get_lan_cache()
+    print_header("PORTAGE TREE SYNC")
+    print_info("Synchronizing Portage tree with emerge-webrsync...")
+    print_info("This downloads the Gentoo package database and may take several minutes...")
+    if lan_cache:
+        result = os.system(f'GENTOO_MIRRORS="{lan_cache}" emerge-webrsync')
+    else:
+        result = os.system("emerge-webrsync")
+    if result != 0:
+        print_error("emerge-webrsync failed")
+        return False
+    print_success("Portage tree synchronized successfully")
+    print_separator()
+    return True
+
+def CONFIGURE_MIRRORS():
+    """Pick mirrors and write GENTOO_MIRRORS. Returns the mirror URLs or None."""
+    lan_cache = get_lan_cache()
+    print_header("MIRROR VALIDATION AND CONFIGURATION")
+    print_info("Validating and configuring Gentoo mirror for package downloads...")
+    print_separator()
+    
+    # Validate and set mirror using the analyzer
+    mirror_urls = validate_and_set_mirror()
+    # The LAN cache goes first so every distfile is fetched upstream only once for the rack
+    if lan_cache:
+        mirror_urls = [lan_cache] + [url for url in (mirror_urls or []) if url != lan_cache]
+    
+    if not mirror_urls:
+        print_error("Failed to configure a valid mirror. Installation cannot continue.")
+        print_error("Please check your network connection and try again.")
+        return None
+    
+    # Configure GENTOO_MIRRORS in make.conf, best mirror first so Portage fails over in order
+    mirrors = " ".join(mirror_urls)
+    print_info(f"Configuring GENTOO_MIRRORS in /etc/portage/make.conf...")
+    print_info(f"Setting mirrors to: {mirrors}")
+    
+    make_conf_path = "/etc/portage/make.conf"
+    
+    try:
+        set_make_conf_mirrors(mirror_urls, make_conf_path)
+        print_success(f"GENTOO_MIRRORS configured: {mirrors}")
+        print_separator()
+    except Exception as e:
+        print_warning(f"Could not write to make.conf directly: {e}")
+        print_info("Using echo to append GENTOO_MIRRORS...")
+        os.system(f'echo \'GENTOO_MIRRORS="{mirrors}"\' >> {make_conf_path}')
+        print_success(f"GENTOO_MIRRORS configured: {mirrors}")
+        print_separator()
+    
+    return mirror_urls
+
+def RESYNC_PORTAGE_TREE():
+    """Bring the Portage tree up to date from the selected mirrors. Returns True on success."""
+    if get_lan_cache():
+        # The snapshot from the LAN cache is as fresh as the rack needs; skip the WAN rsync
+        print_info("Skipping Portage resync, the tree came from the LAN cache")
+        print_separator()
+        return True
+    print_info("Resyncing Portage tree with selected mirrors...")
+    if os.system("emerge --sync --quiet") != 0:
+        print_error("emerge --sync failed")
+        return False
+    print_success("Portage tree resynced with optimized mirrors")
+    print_separator()
+    return True
+
+def SELECT_PROFILE():
+    """Select PROFILENR with eselect. Returns True on success."""
+    print_header("PROFILE SELECTION")
+    print_info(f"Setting Gentoo profile to profile number: {PROFILENR}")
+    if os.system(f"eselect profile set {PROFILENR}") != 0:
+        print_error(f"Failed to set profile {PROFILENR}")
+        return False
+    print_success(f"Profile set to {PROFILENR}")
+    print_separator()
+    return True
+
+def CONFIGURE_BINPKGS():
+    """Configure make.conf for BINPKG_MODE. Returns True on success."""
+    print_header("BINARY PACKAGES")
+    if BINPKG_MODE == "builder":
+        print_info("Builder mode: every package built here is also saved as a binary package")
+    else:
+        print_info(f"Follower mode: installing prebuilt packages from {BINHOST} where they match")
+    if not configure_binpkgs(BINPKG_MODE, BINHOST):
+        print_error(f'BINPKG_MODE must be "builder" or "follower" (with BINHOST set), got "{BINPKG_MODE}"')
+        return False
+    print_success(f"FEATURES configured: {BINPKG_FEATURES[BINPKG_MODE]}")
+    print_separator()
+    return True
+
+def INDEX_BINPKGS():
+    """Regenerate the Packages index of the builder's binary packages. Returns True on success."""
+    print_info("Updating the binary package index...")
+    if os.system("emaint binhost --fix") != 0:
+        print_error("Failed to update the binary package index")
+        return False
+    print_success(f"Binary packages indexed in {portageq('pkgdir') or '/var/cache/binpkgs'}")
+    return True
+
+def UPGRADE_WORLD():
+    """Rebuild @world for the selected profile. Returns True on success."""
+    print_header("SYSTEM UPGRADE")
+    print_info("Upgrading system packages to latest versions...")
+    print_info("This process may take a significant amount of time depending on system specifications...")
+    if not emerge("--verbose --update --deep --changed-use @world"):
+        return False
+    print_success("System upgrade completed")
+    print_separator()
+    return True
+
+def CONFIGURE_TIMEZONE():
+    """Point /etc/localtime at ZONEINFO. Returns True on success."""
+    print_header("TIMEZONE CONFIGURATION")
+    print_info(f"Setting timezone to: {ZONEINFO}")
+    if os.system(f"ln -sf ../usr/share/zoneinfo/{ZONEINFO} /etc/localtime") != 0:
+        print_error(f"Failed to set timezone {ZONEINFO}")
+        return False
+    print_success(f"Timezone configured: {ZONEINFO}")
+    print_separator()
+    return True
+
+def CONFIGURE_LOCALE():
+    """Generate en_US.UTF-8 and select it. Returns True on success."""
+    print_header("LOCALE CONFIGURATION")
+    print_info("Generating locale configuration...")
+    print_info("Adding en_US.UTF-8 to locale.gen...")
+    os.system("""echo "en_US.UTF-8 UTF-8" > /etc/locale.gen""")
+    print_info("Generating locales...")
+    if os.system("locale-gen") != 0:
+        print_error("locale-gen failed")
+        return False
+    print_success("Locales generated successfully")
+    # Now detect and set locale after it's been generated
+    print_info("Detecting and setting system locale...")
+    LOCALE = detect_and_set_locale()
+    print_info(f"Setting locale to option {LOCALE}...")
+    os.system(f"eselect locale set {LOCALE}")
+    print_success(f"Locale configured: option {LOCALE}")
+    print_info("Updating environment with new locale settings...")
+    os.system("env-update")
+    os.system("source /etc/profile")  
+    print_success("Environment updated with locale settings")
+    print_separator()  
+    return True
+
+def PREFETCH_DISTFILES():
+    """Download the distfiles of the whole install ahead of the builds. Returns True even if some
+    downloads failed, since emerge fetches whatever is missing itself."""
+    print_header("DISTFILE PREFETCH")
+    connections = int(cfg_get("PREFETCH_CONNECTIONS", 4))
+    plan = install_plan()
+    # The firmware licenses have to be accepted before their packages resolve
+    plan.write_config()
+    mirror_urls = portageq("envvar", "GENTOO_MIRRORS").split()
+    distdir = portageq("distdir") or "/var/cache/distfiles"
+    
+    print_info("Computing the full package plan (@world update plus install packages)...")
+    files = distfile_fetch_plan(["--update", "--deep", "--changed-use", "@world"] + plan.atoms, mirror_urls)
+    print_info(f"Prefetching {len(files)} distfiles into {distdir} with up to {connections} connections...")
+    fetched, failed = prefetch_distfiles(files, distdir, mirror_urls, connections)
+    print_success(f"Distfile prefetch finished: {fetched} downloaded")
+    if failed:
+        print_warning(f"{failed} distfiles could not be prefetched; emerge will fetch them itself")
+    return True
+
+def INSTALL_PACKAGES_PLAN():
+    """Emerge every package of the install plan in one pass. Returns True if all of them installed."""
+    print_header("PACKAGE INSTALLATION")
+    plan = install_plan()
+    print_info("Configuring package licenses and USE flags...")
+    plan.write_config()
+    ensure_line("/etc/portage/make.conf", 'GRUB_PLATFORMS="efi-64"')
+    print_success("Package licenses, USE flags and GRUB platform configured")
+    
+    jobs = cfg_get("EMERGE_JOBS", 4)
+    print_info(f"Installing {len(plan.atoms)} packages in a single emerge with --jobs={jobs}:")
+    for atom in plan.atoms:
+        print_info(f"  {atom}")
+    print_info("This may take a significant amount of time depending on system specifications...")
+    # --keep-going makes emerge return nonzero when anything failed; the per-atom check says what
+    emerge(" ".join(plan.emerge_args(jobs, cfg_get("MAKEOPTS_L", None))))
+    missing = plan.missing()
+    if missing:
+        print_error(f"These packages failed to install: {', '.join(missing)}")
+        return False
+    print_success("All packages installed")
+    
+    # dracut only puts firmware and microcode into the initramfs if they were there first,
+    # and the single emerge doesn't order them before the kernel
+    print_info("Rebuilding the kernel initramfs with the installed firmware...")
+    if os.system("emerge --config sys-kernel/gentoo-kernel-bin") != 0:
+        print_error("Failed to rebuild the initramfs")
+        return False
+    print_success("Initramfs rebuilt")
+    print_separator()
+    return True
+
+def GENERATE_FSTAB():
+    """Build cfstabgen from source and write /etc/fstab with it. Returns True on success."""
+    print_header("FSTAB GENERATION")
+    if BUNDLE_DIR:
+        print_info("Cloning cfstabgen from the offline bundle...")
+    else:
+        print_info("Cloning cfstabgen from Codeberg...")
+    # A previous, interrupted run may have left a partial clone behind
+    os.system("rm -rf cfstabgen")
+    if os.system(f"git clone {helper_source_url('cfstabgen', BUNDLE_DIR)} cfstabgen") != 0:
+        print_error("Failed to clone cfstabgen")
+        return False
+    print_success("cfstabgen repository cloned")
+    
+    print_info("Building and installing cfstabgen...")
+    if os.system("cd cfstabgen && make && make install") != 0:
+        print_error("Failed to build cfstabgen")
+        return False
+    print_success("cfstabgen installed")
+    
+    if not WRITE_FSTAB():
+        return False
+    print_separator()
+    return True
+
+def CONFIGURE_NETWORK():
+    """Enable dhcpcd for automatic network configuration. Returns True."""
+    print_header("NETWORK CONFIGURATION")
+    print_info("Enabling dhcpcd service for automatic network configuration...")
+    os.system("systemctl enable dhcpcd")
+    print_success("dhcpcd service enabled")
+    print_separator()
+    return True
+
+def SETUP_USERS():
+    """Configure the root and user accounts. Returns True on success."""
+    print_header("USER ACCOUNT CONFIGURATION")
+    if not CONFIGURE_USERS():
+        return False
+    print_separator()
+    return True
+
+def CONFIGURE_SUDOERS():
+    """Write SUDO_CONFIG to /etc/sudoers. Returns True."""
+    print_info("Writing custom sudoers configuration...")
+    with open("/etc/sudoers", "w") as f:
+        f.write(SUDO_CONFIG)
+    print_success("Custom sudoers configuration written")
+    return True
+
+def CRITICALS():
+    print_header("GENTOO INSTALLATION - CHROOT ENVIRONMENT")
+    print_info("Starting installation process inside chroot environment...")
+    print_separator()
+    
+    MOUNT_EFI()
+    
+    # Completed steps are journaled on the target root; a re-run of main.py skips them
+    # as long as their inputs are unchanged and resumes at the first incomplete one
+    journal = StepJournal(STEP_JOURNAL_FILE)
+    if journal.steps:
+        print_info(f"Resuming from {STEP_JOURNAL_FILE}: {len(journal.steps)} steps already completed")
+    else:
+        journal.save()
+    
+    # Each step names the steps it needs and the resources it holds; anything that
+    # doesn't touch Portage runs alongside the emerge chain instead of waiting behind it
+    lan_cache = get_lan_cache()
+    if BUNDLE_DIR:
+        manifest = load_bundle_manifest(BUNDLE_DIR)
+        steps = [
+            InstallStep("offline-setup", OFFLINE_SETUP, locks=["portage"],
+                        inputs={"snapshot": manifest["snapshot"]["sha512"], "distfiles": manifest["distfiles"]}),
+        ]
+        tree_step = "offline-setup"
+    else:
+        steps = [
+            InstallStep("portage-tree", SYNC_PORTAGE_TREE, locks=["portage"], inputs={"lan_cache": lan_cache}),
+            # The step rewrites MIRROR and MIRROR_FAILOVER itself, so only the settings
+            # that drive the selection are inputs
+            InstallStep("mirrors", CONFIGURE_MIRRORS,
+                        inputs={"mirror_list": cfg_get("MIRROR_LIST_FILE", ""), "ranking": cfg_get("MIRROR_RANKING", "latency"),
+                                "failover_count": cfg_get("MIRROR_FAILOVER_COUNT", 3), "lan_cache": lan_cache}),
+            InstallStep("portage-resync", RESYNC_PORTAGE_TREE, deps=["portage-tree", "mirrors"], locks=["portage"],
+                        inputs={"lan_cache": lan_cache}),
+        ]
+        tree_step = "portage-resync"
+    steps.append(InstallStep("profile", SELECT_PROFILE, deps=[tree_step], locks=["portage"], inputs={"profile": PROFILENR}))
+    # Binary package settings have to be in place before the first emerge
+    build_deps = ["profile"]
+    if BINPKG_MODE:
+        steps.append(InstallStep("binpkgs", CONFIGURE_BINPKGS, deps=[tree_step],
+                                 inputs={"mode": BINPKG_MODE, "binhost": BINHOST}))
+        build_deps.append("binpkgs")
+    steps.append(InstallStep("world", UPGRADE_WORLD, deps=build_deps, locks=["portage"],
+                             inputs={"profile": PROFILENR, "binpkg_mode": BINPKG_MODE}))
+    # Fetch the sources for every later build while @world compiles; an offline
+    # bundle already brought its distfiles
+    packages_deps = ["world"]
+    if not BUNDLE_DIR and int(cfg_get("PREFETCH_CONNECTIONS", 4)) > 0:
+        steps.append(InstallStep("prefetch", PREFETCH_DISTFILES, deps=build_deps,
+                                 inputs={"profile": PROFILENR, "packages": INSTALL_PACKAGES}))
+        packages_deps.append("prefetch")
+    steps += [
+        InstallStep("timezone", CONFIGURE_TIMEZONE, inputs={"zoneinfo": ZONEINFO}, outputs=["/etc/localtime"]),
+        InstallStep("locale", CONFIGURE_LOCALE, inputs={"locale": "en_US.UTF-8"}, outputs=["/etc/locale.gen"]),
+        InstallStep("hostname", CONFIGURE_HOSTNAME, inputs={"hostname": HOSTNAME}, outputs=["/etc/hostname", "/etc/hosts"]),
+        # acct-user/acct-group packages edit passwd, group and shadow during emerges too
+        # Passwords stay out of the journal; setting them again is cheap, so the step always runs
+        InstallStep("users", SETUP_USERS, deps=["world"], locks=["portage"], inputs={"username": USERNAME}, always=True),
+        InstallStep("packages", INSTALL_PACKAGES_PLAN, deps=packages_deps, locks=["portage"],
+                    inputs={"packages": INSTALL_PACKAGES, "licenses": INSTALL_LICENSES, "use": INSTALL_USE}),
+        InstallStep("fstab", GENERATE_FSTAB, deps=["packages"],
+                    inputs={"source": helper_source_url("cfstabgen", BUNDLE_DIR)}, outputs=["/etc/fstab"]),
+        InstallStep("network", CONFIGURE_NETWORK, deps=["packages"]),
+        InstallStep("sudoers", CONFIGURE_SUDOERS, deps=["packages"], inputs={"sudoers": SUDO_CONFIG}, outputs=["/etc/sudoers"]),
+        # grub-install and grub-mkconfig need GRUB and the kernel from the package set
+        InstallStep("bootloader", INSTALL_GRUB_EFI, deps=["packages"], inputs={"efi": EFIPT},
+                    outputs=["/boot/efi/grub/grub.cfg"]),
+    ]
+    if BINPKG_MODE == "builder":
+        steps.append(InstallStep("binhost-index", INDEX_BINPKGS, deps=["packages"], locks=["portage"]))
+    
+    # Optionally keep re-ranking the mirrors while the long emerges run
+    make_conf_path = "/etc/portage/make.conf"
+    mirror_monitor = None
+    
+    def step_completed(name, result):
+        nonlocal mirror_monitor
+        if name == "mirrors" and cfg_get("MIRROR_MONITOR", False):
+            print_info("Starting background mirror health monitor...")
+            mirror_monitor = MirrorHealthMonitor(result, make_conf_path)
+            mirror_monitor.start()
+    
+    results, failed = run_step_graph(steps, journal, cfg_get("PARALLEL_STEPS", 4), step_completed)
+    
+    if mirror_monitor:
+        print_info("Stopping background mirror health monitor...")
+        mirror_monitor.stop()
+    
+    if failed or len(results) != len(steps):
+        not_run = [step.name for step in steps if step.name not in results and step.name not in failed]
+        print_error(f"Failed steps: {', '.join(failed) or 'none'}; not run: {', '.join(not_run) or 'none'}")
+        print_error("Fix the problem and re-run main.py to resume from the first incomplete step.")
+        sys.exit(1)
     print_separator()
     
     print_header("FILESYSTEM VERIFICATION")
@@ -535,4 +785,7 @@ def CRITICALS():
     print_separator()
     os.system("exit")
 
-CRITICALS()
\ No newline at end of file
+if GOLDEN_DEPLOY:
+    DEPLOY_HOST_SETUP()
+else:
+    CRITICALS()
\ No newline at end of file
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Gentoo LAN Cache Server
+Caching HTTP mirror for a rack of installs: each stage3, snapshot and distfile
+is fetched from the upstream mirror once and served to every installer from disk
+"""
+
+import argparse
+import os
+import posixpath
+import re
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, unquote
+
+import requests
+
+# Color codes for terminal output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    CYAN = '\033[96m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+def print_success(msg):
+    print(f"{Colors.GREEN}✓ {msg}{Colors.RESET}")
+
+def print_error(msg):
+    print(f"{Colors.RED}✗ ERROR: {msg}{Colors.RESET}")
+
+def print_warning(msg):
+    print(f"{Colors.YELLOW}⚠ WARNING: {msg}{Colors.RESET}")
+
+def print_info(msg):
+    print(f"{Colors.CYAN}ℹ {msg}{Colors.RESET}")
+
+def print_header(msg):
+    print(f"\n{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{msg}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}\n")
+
+def print_separator():
+    print(f"{Colors.CYAN}{'-'*70}{Colors.RESET}")
+
+class CacheEntry:
+    """An artifact being fetched from upstream; clients read the partial file as it grows."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.size = None
+        self.available = 0
+        self.last_modified = None
+        self.done = False
+        self.error = None
+
+class LanCache:
+    """Maps request paths to files under cache_dir, fetching each one from upstream at most once.
+
+    Files whose name contains "latest" (stage3 indexes, portage-latest) change
+    upstream under the same name and are re-fetched once older than ttl seconds;
+    everything else is immutable and kept forever.
+    """
+
+    def __init__(self, upstream, cache_dir, ttl=3600):
+        self.upstream = upstream.rstrip('/') + '/'
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.fetching = {}
+        self.upstream_fetches = 0
+
+    def local_path(self, rel_path):
+        """Return the cache file for a request path, or None if the path escapes the cache."""
+        rel_path = posixpath.normpath(rel_path)
+        if rel_path.startswith("..") or rel_path.startswith("/") or rel_path == ".":
+            return None
+        return os.path.join(self.cache_dir, rel_path)
+
+    def is_fresh(self, path):
+        if not os.path.isfile(path):
+            return False
+        if "latest" not in os.path.basename(path):
+            return True
+        # utime() below resets ctime, so it records when the file was fetched
+        return time.time() - os.stat(path).st_ctime < self.ttl
+
+    def open_entry(self, rel_path):
+        """Return the in-flight CacheEntry for rel_path, starting an upstream fetch if needed,
+        or None if a fresh copy is already on disk."""
+        path = self.local_path(rel_path)
+        with self.lock:
+            if rel_path in self.fetching:
+                return self.fetching[rel_path]
+            if self.is_fresh(path):
+                return None
+            entry = CacheEntry()
+            self.fetching[rel_path] = entry
+            self.upstream_fetches += 1
+        threading.Thread(target=self._fetch, args=(rel_path, path, entry), daemon=True).start()
+        return entry
+
+    def _fetch(self, rel_path, path, entry):
+        part_path = path + ".part"
+        url = self.upstream + rel_path
+        print_info(f"Fetching from upstream: {url}")
+        try:
+            with self.session.get(url, stream=True, timeout=30) as response:
+                if response.status_code != 200:
+                    raise requests.exceptions.HTTPError(response.status_code)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(part_path, "wb") as f:
+                    with entry.cond:
+                        length = response.headers.get("Content-Length")
+                        entry.size = int(length) if length and "Content-Encoding" not in response.headers else None
+                        entry.last_modified = response.headers.get("Last-Modified")
+                        entry.cond.notify_all()
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                        f.flush()
+                        with entry.cond:
+                            entry.available += len(chunk)
+                            entry.cond.notify_all()
+            if entry.size is not None and entry.available != entry.size:
+                raise requests.exceptions.ConnectionError(f"truncated after {entry.available} bytes")
+            # Keep upstream's modification time so Last-Modified stays stable across restarts
+            mtime = time.time()
+            if entry.last_modified:
+                try:
+                    mtime = parsedate_to_datetime(entry.last_modified).timestamp()
+                except (TypeError, ValueError):
+                    pass
+            os.utime(part_path, (mtime, mtime))
+            with entry.cond:
+                os.replace(part_path, path)
+                entry.size = entry.available
+                entry.done = True
+                entry.cond.notify_all()
+            print_success(f"Cached {rel_path} ({entry.size / (1024 * 1024):.1f} MB)")
+        except (requests.exceptions.RequestException, OSError, ValueError) as e:
+            print_warning(f"Upstream fetch failed for {rel_path}: {e}")
+            with entry.cond:
+                entry.error = e
+                entry.cond.notify_all()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        finally:
+            with self.lock:
+                del self.fetching[rel_path]
+
+class LanCacheHandler(BaseHTTPRequestHandler):
+    """Serves HEAD/GET (with single byte ranges) from the server's LanCache."""
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _serve(self, send_body):
+        cache = self.server.cache
+        rel_path = unquote(urlparse(self.path).path).lstrip('/')
+        if not rel_path or rel_path.endswith('/'):
+            # Installers probe the mirror root for reachability
+            self._send_empty(200)
+            return
+        path = cache.local_path(rel_path)
+        if path is None:
+            self._send_empty(404)
+            return
+
+        entry = cache.open_entry(rel_path)
+        if entry:
+            with entry.cond:
+                # Chunked upstream responses have no size until they finish
+                while entry.error is None and not entry.done and entry.size is None:
+                    entry.cond.wait()
+                if entry.error is not None:
+                    self._send_empty(404)
+                    return
+                size = entry.size
+                last_modified = entry.last_modified
+                source = open(path if entry.done else path + ".part", "rb")
+        else:
+            source = open(path, "rb")
+            stat = os.fstat(source.fileno())
+            size = stat.st_size
+            last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+        with source:
+            start, end = 0, size - 1
+            match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start > end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            if last_modified:
+                self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            if send_body:
+                self._send_range(source, entry, start, end)
+
+    def _send_range(self, source, entry, start, end):
+        offset = start
+        try:
+            while offset <= end:
+                if entry and not entry.done:
+                    # Follow the upstream download until the requested bytes have landed
+                    with entry.cond:
+                        while entry.error is None and not entry.done and entry.available <= offset:
+                            entry.cond.wait()
+                        if entry.error is not None:
+                            return
+                        limit = end if entry.done else min(end, entry.available - 1)
+                    data = os.pread(source.fileno(), limit - offset + 1, offset)
+                    self.wfile.write(data)
+                    offset += len(data)
+                else:
+                    self.wfile.flush()
+                    offset += self.connection.sendfile(source, offset, end - offset + 1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        print(f"{Colors.CYAN}   {self.client_address[0]} {format % args}{Colors.RESET}")
+
+def make_server(upstream, cache_dir, port, ttl=3600, address="0.0.0.0"):
+    """Create (but don't start) a LAN cache server; returns the ThreadingHTTPServer."""
+    server = ThreadingHTTPServer((address, port), LanCacheHandler)
+    server.daemon_threads = True
+    server.cache = LanCache(upstream, cache_dir, ttl)
+    return server
+
+def main():
+    """Run the LAN cache server until interrupted."""
+    parser = argparse.ArgumentParser(description="Caching Gentoo mirror for installing many machines on one LAN")
+    parser.add_argument("--upstream", default="https://distfiles.gentoo.org/",
+                        help="upstream mirror root (default: https://distfiles.gentoo.org/)")
+    parser.add_argument("--cache-dir", default="/var/cache/gentoo-installer/lan",
+                        help="where cached files are kept (default: /var/cache/gentoo-installer/lan)")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (default: 8080)")
+    parser.add_argument("--address", default="0.0.0.0", help="address to listen on (default: all)")
+    parser.add_argument("--ttl", type=int, default=3600,
+                        help="seconds before *latest* files are re-fetched from upstream (default: 3600)")
+    args = parser.parse_args()
+
+    server = make_server(args.upstream, args.cache_dir, args.port, args.ttl, args.address)
+    print_header("GENTOO LAN CACHE SERVER")
+    print_info(f"Upstream: {server.cache.upstream}")
+    print_info(f"Cache directory: {args.cache_dir}")
+    print_success(f"Listening on {args.address}:{args.port}")
+    print_info(f'Set "LAN_CACHE": "http://<this-host>:{args.port}/" in each installer\'s config.jsonc')
+    print_separator()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print_info(f"Shutting down after {server.cache.upstream_fetches} upstream fetches")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 import os
+import hashlib
 import sys
-import requests
-import re
+import shutil
 from modules import *
+from detect_makeopts import get_cpu_threads
 
 # Color codes for terminal output
 class Colors:
@@ -39,63 +40,40 @@ ensure_config()
 ROOTPT = cfg_get("ROOTPT")
 EFIPT = cfg_get("EFIPT")
 SWAPPT = cfg_get("SWAPPT")
-URL = "https://gentoo.osuosl.org/releases/amd64/autobuilds/current-stage3-amd64-systemd/latest-stage3-amd64-systemd.txt"
 MAKEOPTS_J = cfg_get("MAKEOPTS_J")
 MAKEOPTS_L = cfg_get("MAKEOPTS_L")
 # INIT = cfg_get("INIT").lower()
 
-resp = requests.get(URL)
-resp.raise_for_status()
-
-lines = [line.strip() for line in resp.text.splitlines() if line.strip()]
-
-# Filter only lines that start with 'stage3-amd64'
-stage3_lines = [line for line in lines if line.startswith("stage3-amd64")]
-
-if not stage3_lines:
-    raise ValueError("No stage3 filename found in the text file.")
-
-# Take the first word of the last stage3 line
-filename = stage3_lines[-1].split()[0]
-
-# Store in PROFILE
-PROFILE = filename
-
-import requests
-import re
-import os
-
 # Get latest stage3
 INIT = cfg_get("INIT", "systemd").lower()
-URL = cfg_get("URL")
-
-# Universal URL handler: automatically add -systemd or -openrc before .txt based on INIT
-# Handle the filename part (before .txt)
-if URL.endswith(".txt"):
-    # Remove any existing -systemd or -openrc before .txt
-    URL = URL.replace("-systemd.txt", ".txt").replace("-openrc.txt", ".txt")
-    # Add the appropriate init system suffix
-    if INIT == "openrc":
-        URL = URL.replace(".txt", "-openrc.txt")
-    else:  # systemd or unknown (default to systemd)
-        URL = URL.replace(".txt", "-systemd.txt")
-
-# Handle the directory path part
-if INIT == "openrc":
-    URL = URL.replace("current-stage3-amd64-systemd", "current-stage3-amd64-openrc")
-    URL = URL.replace("current-stage3-amd64-desktop-systemd", "current-stage3-amd64-desktop-openrc")
-else:  # systemd or unknown (default to systemd)
-    URL = URL.replace("current-stage3-amd64-openrc", "current-stage3-amd64-systemd")
-    URL = URL.replace("current-stage3-amd64-desktop-openrc", "current-stage3-amd64-desktop-systemd")
-
-resp = requests.get(URL)
-resp.raise_for_status()
-lines = [line.strip() for line in resp.text.splitlines() if line.strip()]
-stage3_lines = [line for line in lines if line.startswith("stage3-amd64")]
-PROFILE = stage3_lines[-1].split()[0]
+URL = stage3_index_url(cfg_get("URL"), INIT)
+
+# A golden image replaces the stage3 and the whole package build
+GOLDEN_DEPLOY = cfg_get("GOLDEN_DEPLOY", "")
+GOLDEN_CAPTURE = cfg_get("GOLDEN_CAPTURE", "")
+# A binpkg builder publishes the packages it compiled for follower installs
+BINPKG_MODE = cfg_get("BINPKG_MODE", "").lower()
+BINPKG_PUBLISH_DIR = cfg_get("BINPKG_PUBLISH_DIR", "")
+# An offline bundle pins the stage3 and replaces every network fetch
+OFFLINE_BUNDLE = cfg_get("OFFLINE_BUNDLE", "")
+# A LAN cache server, when reachable, serves the release index and stage3 for the whole rack
+LAN_CACHE = None if OFFLINE_BUNDLE or GOLDEN_DEPLOY else get_lan_cache()
+if LAN_CACHE:
+    URL = lan_cache_url(LAN_CACHE, URL)
+if GOLDEN_DEPLOY:
+    PROFILE = os.path.basename(GOLDEN_DEPLOY)
+elif OFFLINE_BUNDLE:
+    BUNDLE_MANIFEST_DATA = load_bundle_manifest(OFFLINE_BUNDLE)
+    PROFILE = BUNDLE_MANIFEST_DATA["stage3"]["filename"]
+else:
+    PROFILE = resolve_latest_stage3(URL)
 print(f"Latest stage3 ({INIT}): {PROFILE}")
 print_header("GENTOO INSTALLATION SCRIPT")
 print_info(f"Detected latest stage3 tarball: {PROFILE}")
+if GOLDEN_DEPLOY:
+    print_info(f"Deploying golden image: {GOLDEN_DEPLOY}")
+elif OFFLINE_BUNDLE:
+    print_info(f"Installing offline from bundle: {OFFLINE_BUNDLE}")
 print_separator()
 
 # Download - construct BASE_URL from URL
@@ -192,6 +170,206 @@ def ensure_read_write(mount_point, device):
         return True
     return True
 
+def stage3_sources():
+    """Download URLs for the stage3: the LAN cache alone when there is one, else BASE_URL and the mirrors."""
+    return stage3_source_urls(BASE_URL, PROFILE, [] if LAN_CACHE else mirror_urls)
+
+def decompress_threads():
+    """Number of xz decompression threads: XZ_THREADS, or every detected CPU thread if 0."""
+    threads = int(cfg_get("XZ_THREADS", 0))
+    return threads if threads > 0 else get_cpu_threads()
+
+def stage3_already_present(sha512):
+    """Return True if /mnt/gentoo already holds the complete stage3 tarball matching sha512."""
+    path = f"/mnt/gentoo/{PROFILE}"
+    if not sha512 or not os.path.isfile(path) or os.path.exists(download_state_path(path)):
+        return False
+    print_info("Found an existing stage3 tarball, verifying its SHA512...")
+    if file_sha512(path) != sha512:
+        print_warning("Existing stage3 tarball does not match its DIGESTS file, downloading it again")
+        return False
+    print_success(f"Verified stage3 tarball already present, skipping download: {path}")
+    print_separator()
+    return True
+
+def restore_cached_stage3(cache, sha512):
+    """Copy the stage3 tarball from the local cache into /mnt/gentoo. Returns True on a hit."""
+    if not cache or not sha512:
+        return False
+    cached = cache.lookup(PROFILE, sha512)
+    if not cached:
+        print_info(f"Stage3 tarball not in local cache: {cache.cache_dir}")
+        return False
+    method = copy_file_fast(cached, f"/mnt/gentoo/{PROFILE}")
+    print_success(f"Stage3 tarball served from local cache ({method}): {cached}")
+    print_separator()
+    return True
+
+def prepare_offline_bundle():
+    """Make the offline bundle available at BUNDLE_CHROOT_PATH inside /mnt/gentoo.
+
+    Directories are bind-mounted; .tar archives are unpacked straight onto the target disk.
+    Returns the bundle directory as seen from outside the chroot.
+    """
+    bundle_dir = f"/mnt/gentoo{BUNDLE_CHROOT_PATH}"
+    os.makedirs(bundle_dir, exist_ok=True)
+    if os.path.isdir(OFFLINE_BUNDLE):
+        print_info(f"Bind-mounting offline bundle at {bundle_dir}...")
+        result = os.system(f"mount --bind '{OFFLINE_BUNDLE}' '{bundle_dir}'")
+    else:
+        print_info(f"Unpacking offline bundle archive into {bundle_dir}...")
+        result = os.system(f"tar xf '{OFFLINE_BUNDLE}' -C '{bundle_dir}'")
+    if result != 0:
+        print_error(f"Failed to make offline bundle {OFFLINE_BUNDLE} available in /mnt/gentoo")
+        sys.exit(1)
+    print_success("Offline bundle ready")
+    return bundle_dir
+
+def restore_bundle_stage3(bundle_dir):
+    """Copy the stage3 tarball from the offline bundle into /mnt/gentoo and verify it."""
+    stage3 = BUNDLE_MANIFEST_DATA["stage3"]
+    method = copy_file_fast(os.path.join(bundle_dir, "stage3", PROFILE), f"/mnt/gentoo/{PROFILE}")
+    print_info(f"Copied stage3 tarball from offline bundle ({method}), verifying its SHA512...")
+    if file_sha512(f"/mnt/gentoo/{PROFILE}") != stage3["sha512"]:
+        print_error("Stage3 tarball in the offline bundle does not match its recorded SHA512.")
+        sys.exit(1)
+    print_success("Stage3 tarball SHA512 verified")
+    print_separator()
+
+def download_stage3(cache=None, sha512=None):
+    """Download the stage3 tarball into /mnt/gentoo, verify it and add it to the cache."""
+    dest_path = f"/mnt/gentoo/{PROFILE}"
+    print_info(f"Downloading stage3 tarball from: {BASE_URL}{PROFILE}")
+    print_info("This may take several minutes depending on your internet connection...")
+    downloaded = False
+    actual_sha512 = None
+    if cfg_get("STAGE3_DOWNLOAD", "segmented") == "segmented":
+        # Split the tarball across the release host and the ranked mirrors, hashing as segments land
+        sources = stage3_sources()
+        hasher = hashlib.sha512()
+        downloaded = download_segmented(sources, dest_path, hasher)
+        if downloaded:
+            actual_sha512 = hasher.hexdigest()
+        else:
+            print_warning("Segmented download failed, falling back to wget...")
+    if not downloaded:
+        # wget resumes its own partial file; the segmented partial is left for the next run
+        if os.system(f"wget -c -O {dest_path}.wget {BASE_URL}{PROFILE}") != 0:
+            print_error("Failed to download the stage3 tarball. Re-run to resume the download.")
+            sys.exit(1)
+        os.replace(f"{dest_path}.wget", dest_path)
+        if os.path.exists(download_state_path(dest_path)):
+            os.remove(download_state_path(dest_path))
+    if sha512:
+        print_info("Verifying stage3 tarball against its published SHA512...")
+        # wget's output has not been hashed yet and needs a read-back pass
+        if (actual_sha512 or file_sha512(dest_path)) != sha512:
+            print_error("Stage3 tarball is corrupt or truncated: it does not match the SHA512 in its DIGESTS file.")
+            os.remove(dest_path)
+            sys.exit(1)
+        print_success("Stage3 tarball SHA512 verified")
+        if cache and cache.store(dest_path, PROFILE, sha512):
+            print_info(f"Stage3 tarball added to local cache: {cache.cache_dir}")
+    else:
+        # Only verified tarballs are cached; the cache is keyed by their SHA512
+        print_warning("No published SHA512 for the stage3 tarball, extracting it unverified")
+    print_success("Stage3 tarball downloaded successfully")
+    print_separator()
+
+def extract_stage3():
+    """Extract the downloaded stage3 tarball in /mnt/gentoo."""
+    # Extract with error checking
+    print_info("Extracting stage3 tarball...")
+    print_info("This process extracts the Gentoo base system and may take a few minutes...")
+    # Ensure filesystem is still read-write before extraction
+    ensure_read_write("/mnt/gentoo", ROOTPT)
+    threads = decompress_threads()
+    blocks = count_xz_blocks(f"/mnt/gentoo/{PROFILE}")
+    if blocks and blocks > 1:
+        print_info(f"Decompressing {blocks} xz blocks with up to {threads} threads...")
+    else:
+        print_info("Tarball is a single xz block, decompressing on one thread...")
+    tar_result = os.system(f"cd /mnt/gentoo && tar xpvf {PROFILE} '{xz_tar_flag(threads)}' --xattrs-include='*.*' --numeric-owner 2>&1")
+    if tar_result != 0:
+        print_error("Failed to extract stage3 tarball. This may indicate disk space issues.")
+        print_error("Check available space and filesystem errors.")
+        # Check filesystem status
+        ensure_read_write("/mnt/gentoo", ROOTPT)
+        sys.exit(1)
+    finish_stage3_extraction()
+
+def stream_stage3():
+    """Download and extract an unverifiable stage3 tarball in one pass, without saving the tarball."""
+    print_info(f"Streaming stage3 tarball from: {BASE_URL}{PROFILE}")
+    print_info("Extracting while downloading; the tarball itself is never written to disk...")
+    ensure_read_write("/mnt/gentoo", ROOTPT)
+    sources = stage3_sources()
+    print_warning("No published SHA512 for the stage3 tarball, extracting it unverified")
+    if not stream_extract_tarball(sources, "/mnt/gentoo", decompress_threads()):
+        print_error("Failed to stream and extract the stage3 tarball from any source.")
+        print_error("Check your network connection, available space and filesystem errors.")
+        ensure_read_write("/mnt/gentoo", ROOTPT)
+        sys.exit(1)
+    finish_stage3_extraction()
+
+def deploy_golden_image():
+    """Stream a golden root image onto /mnt/gentoo in place of the stage3."""
+    print_header("GOLDEN IMAGE DEPLOY")
+    print_info(f"Streaming golden image onto {ROOTPT}: {GOLDEN_DEPLOY}")
+    ensure_read_write("/mnt/gentoo", ROOTPT)
+    sha512 = fetch_image_digest(GOLDEN_DEPLOY)
+    if not sha512:
+        print_warning("No .sha512 file next to the golden image, deploying it unverified")
+    if not deploy_rootfs_image(GOLDEN_DEPLOY, "/mnt/gentoo", decompress_threads(), sha512):
+        print_error("Failed to deploy the golden image.")
+        ensure_read_write("/mnt/gentoo", ROOTPT)
+        sys.exit(1)
+    finish_stage3_extraction()
+
+def capture_golden_image():
+    """Capture the finished /mnt/gentoo root as a golden image for the rest of the fleet."""
+    print_header("GOLDEN IMAGE CAPTURE")
+    print_info(f"Capturing /mnt/gentoo into {GOLDEN_CAPTURE}...")
+    print_info("Per-host files (fstab, hostname, machine-id, SSH host keys) are left out")
+    os.system("sync")
+    sha512 = capture_rootfs_image("/mnt/gentoo", GOLDEN_CAPTURE, decompress_threads())
+    if not sha512:
+        print_error("Golden image capture failed.")
+        return
+    size_mb = os.path.getsize(GOLDEN_CAPTURE) / (1024 * 1024)
+    print_success(f"Golden image written: {GOLDEN_CAPTURE} ({size_mb:.1f} MB)")
+    print_info(f'Set "GOLDEN_DEPLOY" to this path or an http(s) URL for it on the other machines')
+    print_separator()
+
+def publish_binpkgs():
+    """Copy the builder's binary packages to BINPKG_PUBLISH_DIR for binhost.py to serve."""
+    pkgdir = "/mnt/gentoo/var/cache/binpkgs"
+    print_header("BINARY PACKAGE PUBLISH")
+    if not os.path.isfile(os.path.join(pkgdir, "Packages")):
+        print_warning(f"No binary package index in {pkgdir}, nothing to publish")
+        return
+    print_info(f"Copying binary packages from {pkgdir} to {BINPKG_PUBLISH_DIR}...")
+    # The index goes last, so followers never see packages that haven't been copied yet
+    shutil.copytree(pkgdir, BINPKG_PUBLISH_DIR, dirs_exist_ok=True, copy_function=copy_file_fast,
+                    ignore=lambda directory, names: ["Packages"] if directory == pkgdir else [])
+    index_tmp = os.path.join(BINPKG_PUBLISH_DIR, "Packages.tmp")
+    shutil.copyfile(os.path.join(pkgdir, "Packages"), index_tmp)
+    os.replace(index_tmp, os.path.join(BINPKG_PUBLISH_DIR, "Packages"))
+    print_success(f"Binary packages published in {BINPKG_PUBLISH_DIR}")
+    print_info(f"Serve them with: python3 binhost.py --dir {BINPKG_PUBLISH_DIR}")
+    print_info('Then set "BINPKG_MODE": "follower" and "BINHOST": "http://<this-host>:8081/" on the other machines')
+    print_separator()
+
+def finish_stage3_extraction():
+    """Sync and re-check the target filesystem after the stage3 is extracted."""
+    # Sync after extraction to ensure all data is written
+    print_info("Synchronizing filesystem after extraction...")
+    os.system("sync")
+    # Verify still read-write after extraction
+    ensure_read_write("/mnt/gentoo", ROOTPT)
+    print_success("Stage3 tarball extracted successfully")
+    print_separator()
+
 def MOUNT():
     print_header("MOUNTING ROOT PARTITION")
     print_info("Creating mount point directory: /mnt/gentoo")
@@ -259,32 +437,44 @@ def MOUNT():
         print_success(f"Sufficient disk space available ({free_gb:.2f} GB)")
     print_separator()
     
-    print_info(f"Downloading stage3 tarball from: {BASE_URL}{PROFILE}")
-    print_info("This may take several minutes depending on your internet connection...")
-    os.system(f"wget -P /mnt/gentoo {BASE_URL}/{PROFILE}")
-    print_success("Stage3 tarball downloaded successfully")
-    print_separator()
+    if GOLDEN_DEPLOY:
+        deploy_golden_image()
+        PREPARE_CHROOT(None)
+        return
     
-    # Extract with error checking
-    print_info("Extracting stage3 tarball...")
-    print_info("This process extracts the Gentoo base system and may take a few minutes...")
-    # Ensure filesystem is still read-write before extraction
-    ensure_read_write("/mnt/gentoo", ROOTPT)
-    tar_result = os.system(f"cd /mnt/gentoo && tar xpvf stage3-*.tar.xz --xattrs-include='*.*' --numeric-owner 2>&1")
-    if tar_result != 0:
-        print_error("Failed to extract stage3 tarball. This may indicate disk space issues.")
-        print_error("Check available space and filesystem errors.")
-        # Check filesystem status
-        ensure_read_write("/mnt/gentoo", ROOTPT)
-        sys.exit(1)
-    # Sync after extraction to ensure all data is written
-    print_info("Synchronizing filesystem after extraction...")
-    os.system("sync")
-    # Verify still read-write after extraction
-    ensure_read_write("/mnt/gentoo", ROOTPT)
-    print_success("Stage3 tarball extracted successfully")
-    print_separator()
+    bundle_dir = prepare_offline_bundle() if OFFLINE_BUNDLE else None
+    # A step journal means an earlier run already unpacked stage3 and got into the chroot;
+    # unpacking it again would roll back everything that run installed
+    if os.path.exists("/mnt/gentoo" + STEP_JOURNAL_FILE):
+        print_info(f"Found step journal /mnt/gentoo{STEP_JOURNAL_FILE}, resuming the previous installation")
+        print_separator()
+        PREPARE_CHROOT(bundle_dir)
+        return
     
+    # An existing or cached tarball is reused only when it matches the release's published SHA512
+    stage3_cache = None if bundle_dir else get_stage3_cache()
+    stage3_sha512 = BUNDLE_MANIFEST_DATA["stage3"]["sha512"] if bundle_dir else fetch_stage3_digest(BASE_URL, PROFILE)
+    if stage3_already_present(stage3_sha512):
+        extract_stage3()
+    elif bundle_dir:
+        restore_bundle_stage3(bundle_dir)
+        extract_stage3()
+    elif restore_cached_stage3(stage3_cache, stage3_sha512):
+        extract_stage3()
+    elif cfg_get("STAGE3_EXTRACT", "file") == "stream" and not stage3_sha512:
+        stream_stage3()
+    else:
+        # Streaming unpacks before the digest can be compared, so a tarball with a
+        # published SHA512 is always downloaded and verified before extraction
+        if cfg_get("STAGE3_EXTRACT", "file") == "stream":
+            print_info("Stage3 has a published SHA512, downloading and verifying it before extraction instead of streaming")
+        download_stage3(stage3_cache, stage3_sha512)
+        extract_stage3()
+    
+    CONFIGURE_PORTAGE()
+    PREPARE_CHROOT(bundle_dir)
+
+def CONFIGURE_PORTAGE():
     print_header("CONFIGURING PORTAGE")
     print_info("Creating /etc/portage directory structure...")
     os.system("mkdir -p /mnt/gentoo/etc/portage")
@@ -294,7 +484,8 @@ def MOUNT():
     os.system(f"cd /mnt/gentoo && echo 'MAKEOPTS=\"-j{MAKEOPTS_J} -l{MAKEOPTS_L}\"' >> etc/portage/make.conf")
     print_success("MAKEOPTS configured in /etc/portage/make.conf")
     print_separator()
-    
+
+def PREPARE_CHROOT(bundle_dir):
     print_header("PREPARING CHROOT ENVIRONMENT")
     print_info("Copying resolv.conf for network configuration in chroot...")
     os.system("cp --dereference /etc/resolv.conf /mnt/gentoo/etc/")
@@ -304,6 +495,10 @@ def MOUNT():
     # Ensure read-write before copying
     ensure_read_write("/mnt/gentoo", ROOTPT)
     os.system("cp in_chroot.py /mnt/gentoo/ && cp modules.py /mnt/gentoo/ && cp config.jsonc /mnt/gentoo/")
+    # Share mirror measurements so the chroot phase doesn't re-probe fresh mirrors
+    if os.path.exists(MIRROR_CACHE_FILE):
+        os.system(f"cp {MIRROR_CACHE_FILE} /mnt/gentoo/")
+        print_success(f"Copied {MIRROR_CACHE_FILE} to /mnt/gentoo/")
     os.system("sync")
     print_success("Copied in_chroot.py, modules.py, and config.jsonc to /mnt/gentoo/")
     print_separator()
@@ -314,9 +509,24 @@ def MOUNT():
     # Final check before chroot
     ensure_read_write("/mnt/gentoo", ROOTPT)
     print_separator()
-    os.system("arch-chroot /mnt/gentoo python in_chroot.py")
+    chroot_result = os.system("arch-chroot /mnt/gentoo python in_chroot.py")
     # Check after chroot exits
     ensure_read_write("/mnt/gentoo", ROOTPT)
+    if bundle_dir and os.path.ismount(bundle_dir):
+        os.system(f"umount '{bundle_dir}'")
+    
+    # Only a freshly built root is worth capturing for the rest of the fleet
+    if GOLDEN_CAPTURE and not GOLDEN_DEPLOY:
+        if chroot_result == 0:
+            capture_golden_image()
+        else:
+            print_warning("Chroot installation failed, skipping golden image capture")
+    
+    if BINPKG_MODE == "builder" and BINPKG_PUBLISH_DIR:
+        if chroot_result == 0:
+            publish_binpkgs()
+        else:
+            print_warning("Chroot installation failed, skipping binary package publish")
     
     print_separator()
     print_success("Chroot session completed successfully!")
@@ -326,10 +536,20 @@ require_root()
 
 # Validate and configure mirror
 print_separator()
-mirror_url = validate_and_set_mirror()
-if not mirror_url:
-    print_error("Failed to configure a valid mirror. Installation cannot continue.")
-    sys.exit(1)
+if GOLDEN_DEPLOY:
+    print_info("Golden image deploy, skipping mirror selection")
+    mirror_urls = []
+elif OFFLINE_BUNDLE:
+    print_info("Offline install, skipping mirror selection")
+    mirror_urls = []
+elif LAN_CACHE:
+    print_info("Stage3 comes from the LAN cache, mirrors are selected inside the chroot")
+    mirror_urls = []
+else:
+    mirror_urls = validate_and_set_mirror()
+    if not mirror_urls:
+        print_error("Failed to configure a valid mirror. Installation cannot continue.")
+        sys.exit(1)
 print_separator()
 
 # Check if partition is formatted, if not, format it
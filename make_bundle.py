@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Gentoo Offline Install Bundle Builder
+Collects the stage3, a repository snapshot, distfiles and helper sources into
+one directory (optionally a .tar archive) that main.py can install from offline
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from modules import *
+
+# Color codes for terminal output
+class Colors:
+    GREEN = '\033[92m'
+    RED = '\033[91m'
+    YELLOW = '\033[93m'
+    BLUE = '\033[94m'
+    CYAN = '\033[96m'
+    RESET = '\033[0m'
+    BOLD = '\033[1m'
+
+def print_success(msg):
+    print(f"{Colors.GREEN}✓ {msg}{Colors.RESET}")
+
+def print_error(msg):
+    print(f"{Colors.RED}✗ ERROR: {msg}{Colors.RESET}")
+
+def print_warning(msg):
+    print(f"{Colors.YELLOW}⚠ WARNING: {msg}{Colors.RESET}")
+
+def print_info(msg):
+    print(f"{Colors.CYAN}ℹ {msg}{Colors.RESET}")
+
+def print_header(msg):
+    print(f"\n{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{msg}{Colors.RESET}")
+    print(f"{Colors.BOLD}{Colors.BLUE}{'='*70}{Colors.RESET}\n")
+
+def print_separator():
+    print(f"{Colors.CYAN}{'-'*70}{Colors.RESET}")
+
+SNAPSHOT_PATH = "snapshots/portage-latest.tar.xz"
+
+def download_verified(urls, dest_path):
+    """Download urls[0] (or its mirrors) to dest_path, returning its SHA512 or None on failure."""
+    hasher = hashlib.sha512()
+    if not download_segmented(urls, dest_path, hasher):
+        return None
+    return hasher.hexdigest()
+
+def bundle_stage3(bundle_dir, mirror_urls):
+    """Download and verify the latest stage3 into the bundle. Returns its manifest entry or None."""
+    print_header("STAGE3")
+    index_url = stage3_index_url(cfg_get("URL"), cfg_get("INIT", "systemd").lower())
+    filename = resolve_latest_stage3(index_url)
+    base_url = index_url.rsplit('/', 1)[0] + '/'
+    print_info(f"Latest stage3: {filename}")
+
+    sha512 = fetch_stage3_digest(base_url, filename)
+    if not sha512:
+        print_error("No published SHA512 for the stage3 tarball; refusing to bundle it unverified")
+        return None
+    dest_path = os.path.join(bundle_dir, "stage3", filename)
+    if os.path.isfile(dest_path) and not os.path.exists(download_state_path(dest_path)) \
+            and file_sha512(dest_path) == sha512:
+        print_success("Verified stage3 already in bundle, skipping download")
+        return {"filename": filename, "sha512": sha512, "index_url": index_url}
+
+    # Reuse a verified copy from the local stage3 cache when there is one
+    cache = get_stage3_cache()
+    cached = cache.lookup(filename, sha512) if cache else None
+    if cached:
+        print_success(f"Copied stage3 from local cache ({copy_file_fast(cached, dest_path)})")
+        return {"filename": filename, "sha512": sha512, "index_url": index_url}
+
+    if download_verified(stage3_source_urls(base_url, filename, mirror_urls), dest_path) != sha512:
+        print_error("Stage3 tarball does not match the SHA512 in its DIGESTS file")
+        return None
+    print_success(f"Stage3 downloaded and verified: {filename}")
+    return {"filename": filename, "sha512": sha512, "index_url": index_url}
+
+def bundle_snapshot(bundle_dir, mirror_urls):
+    """Download the latest repository snapshot into the bundle. Returns its manifest entry or None."""
+    print_header("REPOSITORY SNAPSHOT")
+    urls = [mirror.rstrip('/') + '/' + SNAPSHOT_PATH for mirror in mirror_urls]
+    filename = os.path.basename(SNAPSHOT_PATH)
+    print_info(f"Downloading {filename} from {len(urls)} mirrors...")
+
+    # Mirrors publish an md5sum next to the snapshot; check it against the bytes we got
+    expected_md5 = None
+    try:
+        response = requests.get(urls[0] + ".md5sum", timeout=30)
+        response.raise_for_status()
+        expected_md5 = response.text.split()[0].lower()
+    except (requests.exceptions.RequestException, IndexError) as e:
+        print_warning(f"Could not fetch the snapshot md5sum: {e}")
+
+    dest_path = os.path.join(bundle_dir, "snapshot", filename)
+    sha512 = download_verified(urls, dest_path)
+    if not sha512:
+        print_error("Failed to download the repository snapshot")
+        return None
+    if expected_md5:
+        md5 = hashlib.md5()
+        with open(dest_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5.update(chunk)
+        if md5.hexdigest() != expected_md5:
+            print_error("Repository snapshot does not match its published md5sum")
+            return None
+    print_success(f"Repository snapshot downloaded: {filename}")
+    return {"filename": filename, "sha512": sha512}
+
+def target_profile(repo_dir):
+    """Return the profile path the target will select, from PROFILE in config.jsonc.
+
+    PROFILE is normally the number passed to `eselect profile set`, which
+    counts the amd64 entries of profiles.desc in order; a profile path is
+    used as is.
+    """
+    profile = str(cfg_get("PROFILE"))
+    if not profile.isdigit():
+        return profile
+    with open(os.path.join(repo_dir, "profiles", "profiles.desc"), encoding="utf-8") as f:
+        entries = [line.split() for line in f if line.strip() and not line.startswith("#")]
+    paths = [fields[1] for fields in entries if len(fields) >= 2 and fields[0] == "amd64"]
+    if not 1 <= int(profile) <= len(paths):
+        raise ValueError(f"PROFILE {profile} is not in the snapshot's profiles.desc")
+    return paths[int(profile) - 1]
+
+def bundle_distfiles(bundle_dir, snapshot, extra_packages):
+    """Fetch the distfiles of @system plus the install plan into the bundle. Returns the names or None on failure.
+
+    Resolves against the bundled snapshot with a throwaway PORTAGE_CONFIGROOT
+    holding the target's profile and the plan's license and USE entries, so
+    the versions match what the target will build and nothing from the build
+    host's /etc/portage leaks in. Needs Portage on the build host.
+    """
+    print_header("DISTFILES")
+    if not shutil.which("emerge"):
+        print_error("emerge not found; build the bundle on a host with Portage, or pass --no-distfiles")
+        return None
+    distdir = os.path.abspath(os.path.join(bundle_dir, "distfiles"))
+    plan = install_plan()
+    for atom in extra_packages:
+        plan.add(atom)
+    
+    with tempfile.TemporaryDirectory(prefix="install-bundle-") as work_dir:
+        repo_dir = os.path.join(work_dir, "repo")
+        print_info(f"Unpacking {snapshot['filename']} to resolve against it...")
+        if not install_bundle_snapshot(bundle_dir, {"snapshot": snapshot}, repo_dir):
+            print_error("Failed to unpack the bundled repository snapshot")
+            return None
+        try:
+            profile = target_profile(repo_dir)
+        except (OSError, ValueError) as e:
+            print_error(f"Could not determine the target profile: {e}")
+            return None
+        print_info(f"Target profile: {profile}")
+        
+        portage_dir = os.path.join(work_dir, "etc", "portage")
+        os.makedirs(portage_dir)
+        os.symlink(os.path.join(repo_dir, "profiles", profile), os.path.join(portage_dir, "make.profile"))
+        with open(os.path.join(portage_dir, "make.conf"), "w") as f:
+            f.write('ACCEPT_LICENSE="-* @FREE"\n')
+            f.write('GRUB_PLATFORMS="efi-64"\n')
+        plan.write_config(portage_dir)
+        env = dict(os.environ,
+                   PORTAGE_CONFIGROOT=work_dir,
+                   PORTAGE_REPOSITORIES=f"[DEFAULT]\nmain-repo = gentoo\n\n[gentoo]\nlocation = {repo_dir}\n",
+                   DISTDIR=distdir)
+        
+        # The target's world file is empty apart from what in_chroot.py installs, so
+        # @system stands in for @world; --emptytree ignores what the build host has installed
+        command = ["emerge", "--fetchonly", "--emptytree", "--quiet", "@system"] + plan.atoms
+        print_info(f"Running: {' '.join(command)}")
+        result = subprocess.run(command, env=env)
+    if result.returncode != 0:
+        print_error("emerge --fetchonly failed; the bundle would be missing distfiles")
+        return None
+    distfiles = sorted(name for name in os.listdir(distdir)
+                       if os.path.isfile(os.path.join(distdir, name)) and not name.startswith("."))
+    print_success(f"{len(distfiles)} distfiles in bundle")
+    return distfiles
+
+def bundle_sources(bundle_dir):
+    """Mirror-clone each helper source repository into the bundle. Returns the names bundled."""
+    print_header("HELPER SOURCES")
+    bundled = []
+    for name, url in HELPER_SOURCES.items():
+        dest = os.path.join(bundle_dir, "sources", f"{name}.git")
+        if os.path.isdir(dest):
+            result = subprocess.run(["git", "-C", dest, "remote", "update", "--prune"])
+        else:
+            result = subprocess.run(["git", "clone", "--mirror", url, dest])
+        if result.returncode != 0:
+            print_error(f"Failed to clone {url}")
+            continue
+        print_success(f"Bundled {name} from {url}")
+        bundled.append(name)
+    return bundled
+
+def write_archive(bundle_dir, archive_path):
+    """Pack the bundle into an uncompressed tar; its contents are already compressed."""
+    print_info(f"Writing bundle archive {archive_path}...")
+    with tarfile.open(archive_path, "w") as tar:
+        # The manifest goes first so main.py can read it without scanning the archive
+        tar.add(os.path.join(bundle_dir, BUNDLE_MANIFEST), arcname=BUNDLE_MANIFEST)
+        for name in sorted(os.listdir(bundle_dir)):
+            if name != BUNDLE_MANIFEST:
+                tar.add(os.path.join(bundle_dir, name), arcname=name)
+    print_success(f"Bundle archive written: {archive_path}")
+
+def main():
+    """Build the offline install bundle."""
+    parser = argparse.ArgumentParser(description="Build an offline install bundle for main.py")
+    parser.add_argument("--output", default="install-bundle", help="bundle directory (default: install-bundle)")
+    parser.add_argument("--archive", help="also pack the bundle into this .tar file")
+    parser.add_argument("--package", action="append", default=[], metavar="ATOM",
+                        help="extra package whose distfiles to include (repeatable)")
+    parser.add_argument("--no-distfiles", action="store_true", help="skip fetching distfiles")
+    args = parser.parse_args()
+
+    print_header("GENTOO OFFLINE BUNDLE BUILDER")
+    for sub in ("stage3", "snapshot", "distfiles", "sources"):
+        os.makedirs(os.path.join(args.output, sub), exist_ok=True)
+
+    mirror_urls = validate_and_set_mirror()
+    if not mirror_urls:
+        print_error("Failed to configure a valid mirror. The bundle cannot be built.")
+        sys.exit(1)
+
+    stage3 = bundle_stage3(args.output, mirror_urls)
+    snapshot = bundle_snapshot(args.output, mirror_urls)
+    if not stage3 or not snapshot:
+        sys.exit(1)
+    distfiles = [] if args.no_distfiles else bundle_distfiles(args.output, snapshot, args.package)
+    if distfiles is None:
+        sys.exit(1)
+    sources = bundle_sources(args.output)
+    if set(sources) != set(HELPER_SOURCES):
+        sys.exit(1)
+
+    manifest = {
+        "created": time.time(),
+        "stage3": stage3,
+        "snapshot": snapshot,
+        "distfiles": distfiles,
+        "sources": sources
+    }
+    with open(os.path.join(args.output, BUNDLE_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    print_separator()
+    print_success(f"Offline bundle ready in {args.output}")
+
+    if args.archive:
+        write_archive(args.output, args.archive)
+    print_info('Set "OFFLINE_BUNDLE" in config.jsonc to the bundle path and run main.py')
+    print_separator()
+
+if __name__ == "__main__":
+    main()
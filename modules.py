@@ -1,10 +1,28 @@
+import errno
+import fcntl
+import hashlib
 import json
+import math
 import re
+import shutil
 import subprocess
 import os
+import tarfile
+import tempfile
 import requests
+import socket
+import threading
 import time
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
 
 # Try to import statistics, fallback to manual calculation
 try:
@@ -14,10 +32,27 @@ except ImportError:
     HAS_STATISTICS = False
 
 CONFIG_FILE = "config.jsonc"
+MIRROR_CACHE_FILE = "mirror_cache.json"
+RELEASE_CACHE_FILE = "release_cache.json"
+# Absolute path inside the target root; main.py checks it under /mnt/gentoo
+STEP_JOURNAL_FILE = "/var/lib/gentoo-installer/journal.json"
+
+# Keep-alive HTTP sessions shared by mirror probes, one per (scheme, host)
+_MIRROR_SESSIONS = {}
+_MIRROR_SESSIONS_LOCK = threading.Lock()
+_CONNECTION_PHASES = {}
+
+# Install steps run on worker threads and read and update config.jsonc concurrently
+_CONFIG_LOCK = threading.RLock()
+
+# make.conf and the package.* files are edited by chroot steps and the mirror
+# monitor thread at the same time; every writer holds this lock
+_PORTAGE_CONFIG_LOCK = threading.RLock()
 
 def _load():
-    with open(CONFIG_FILE, encoding="utf-8") as f:
-        lines = f.readlines()
+    with _CONFIG_LOCK:
+        with open(CONFIG_FILE, encoding="utf-8") as f:
+            lines = f.readlines()
 
     clean_lines = []
     for line in lines:
@@ -42,9 +77,19 @@ def _load():
 
 
 def _save(data):
-    """Save configuration to file."""
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+    """Save configuration to file, replacing it atomically so readers never see a partial file."""
+    with _CONFIG_LOCK:
+        fd, tmp_path = tempfile.mkstemp(prefix=".config.", dir=os.path.dirname(os.path.abspath(CONFIG_FILE)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=2)
+            if os.path.exists(CONFIG_FILE):
+                os.chmod(tmp_path, os.stat(CONFIG_FILE).st_mode & 0o7777)
+            os.replace(tmp_path, CONFIG_FILE)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
 def cfg_get(key, default=None):
     """Get a value from the config."""
@@ -53,9 +98,10 @@ def cfg_get(key, default=None):
 
 def cfg_set(key, value):
     """Set a value in the config."""
-    data = _load()
-    data[key] = value
-    _save(data)
+    with _CONFIG_LOCK:
+        data = _load()
+        data[key] = value
+        _save(data)
 
 def detect_and_set_locale():
     """Detect and set the locale from eselect."""
@@ -330,15 +376,236 @@ GENTOO_MIRRORS = [
     {"url": "http://mirror.ufs.ac.za/gentoo/", "name": "University of the Free State", "country": "ZA", "protocol": "http", "ipv6": True},
 ]
 
+def mirror_host_key(url):
+    """Identify the physical host behind a mirror URL; protocol variants share the same key."""
+    parsed = urlparse(url)
+    # Only an explicit port distinguishes servers on one host, not the scheme's default
+    return f"{parsed.hostname}:{parsed.port}" if parsed.port else parsed.hostname
+
+class MirrorRegistry:
+    """Deduplicated mirror table indexed by host, country and protocol.
+
+    Entries with the same URL are merged (keeping every country they were listed
+    under), and each physical host has one representative that is probed on
+    behalf of all its protocol variants.
+    """
+    
+    def __init__(self, mirrors, source="built-in mirror list"):
+        self.source = source
+        self.mirrors = []
+        self.by_url = {}
+        self.by_host = {}
+        self.by_country = {}
+        self.by_protocol = {}
+        for mirror in mirrors:
+            self.add(mirror)
+    
+    def add(self, mirror):
+        """Add a mirror entry, merging it into an existing entry with the same URL."""
+        url = mirror["url"]
+        country = mirror.get("country", "Unknown")
+        existing = self.by_url.get(url)
+        if existing is not None:
+            if country not in existing["countries"]:
+                existing["countries"].append(country)
+                self.by_country.setdefault(country, []).append(existing)
+            return existing
+        
+        entry = dict(mirror)
+        entry["countries"] = [country]
+        self.mirrors.append(entry)
+        self.by_url[url] = entry
+        self.by_host.setdefault(mirror_host_key(url), []).append(entry)
+        self.by_country.setdefault(country, []).append(entry)
+        self.by_protocol.setdefault(entry.get("protocol", "https"), []).append(entry)
+        return entry
+    
+    def representative(self, url):
+        """Return the entry probed on behalf of url's host, preferring HTTPS."""
+        variants = self.by_host.get(mirror_host_key(url), [])
+        if not variants:
+            return None
+        https = [m for m in variants if m.get("protocol") == "https"]
+        return (https or variants)[0]
+    
+    def hosts(self):
+        """Return one representative entry per physical host, in table order."""
+        seen = set()
+        representatives = []
+        for mirror in self.mirrors:
+            representative = self.representative(mirror["url"])
+            if representative["url"] not in seen:
+                seen.add(representative["url"])
+                representatives.append(representative)
+        return representatives
+    
+    def variants(self, url):
+        """Return the other entries served by the same host as url."""
+        return [m for m in self.by_host.get(mirror_host_key(url), []) if m["url"] != url]
+    
+    def expand_results(self, results):
+        """Add results for protocol variants, derived from their host's measured result."""
+        expanded = []
+        for result in results:
+            expanded.append(result)
+            for variant in self.variants(result["url"]):
+                derived = dict(result)
+                derived.update({
+                    "url": variant["url"],
+                    "name": variant["name"],
+                    "protocol": variant.get("protocol", "https"),
+                    "derived_from": result["url"]
+                })
+                expanded.append(derived)
+        return expanded
+    
+    @classmethod
+    def from_file(cls, path):
+        """Load a registry from a JSON mirror list or a Gentoo mirrors3.xml file."""
+        if path.endswith(".xml"):
+            mirrors = []
+            root = ET.parse(path).getroot()
+            for group in root.iter("mirrorgroup"):
+                country = group.get("country", "Unknown")
+                for mirror in group.iter("mirror"):
+                    name = (mirror.findtext("name") or "").strip()
+                    for uri in mirror.iter("uri"):
+                        protocol = uri.get("protocol", "")
+                        # Portage only fetches over HTTP(S) here
+                        if protocol not in ("http", "https"):
+                            continue
+                        mirrors.append({
+                            "url": (uri.text or "").strip(),
+                            "name": name,
+                            "country": country,
+                            "protocol": protocol,
+                            "ipv6": uri.get("ipv6", "n").lower() == "y"
+                        })
+        else:
+            with open(path, encoding="utf-8") as f:
+                mirrors = json.load(f)
+        return cls(mirrors, source=path)
+
+def get_mirror_registry():
+    """Build the mirror registry from MIRROR_LIST_FILE if configured, else the built-in list."""
+    path = cfg_get("MIRROR_LIST_FILE", "")
+    if path:
+        try:
+            return MirrorRegistry.from_file(path)
+        except (OSError, ValueError, ET.ParseError, KeyError) as e:
+            print(f"\033[93m⚠ WARNING: Could not load mirror list {path}: {e}, using built-in list\033[0m")
+    return MirrorRegistry(GENTOO_MIRRORS)
+
+class _PhaseTimingConnectionMixin:
+    """Times DNS lookup, TCP connect and TLS handshake of a pooled connection as it is opened.
+
+    The first connection opened to each host is recorded in _CONNECTION_PHASES,
+    so the phases come from the same connection the latency samples reuse.
+    """
+    _phase_scheme = "http"
+
+    def _new_conn(self):
+        host = self._dns_host
+        start = time.perf_counter()
+        try:
+            addrinfo = socket.getaddrinfo(host.strip("[]"), self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError:
+            # Let urllib3 raise its own resolution error
+            return super()._new_conn()
+        self._dns_ms = (time.perf_counter() - start) * 1000
+        
+        # Connect to the addresses just resolved, in order, so DNS isn't timed twice
+        addresses = list(dict.fromkeys(info[4][0] for info in addrinfo))
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address
+                start = time.perf_counter()
+                try:
+                    sock = super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    error = e
+                    continue
+                self._connect_ms = (time.perf_counter() - start) * 1000
+                return sock
+        finally:
+            self._dns_host = host
+        raise error
+
+    def connect(self):
+        self._dns_ms = self._connect_ms = None
+        start = time.perf_counter()
+        super().connect()
+        if self._connect_ms is None:
+            return
+        total_ms = (time.perf_counter() - start) * 1000
+        tls_ms = max(0.0, total_ms - self._dns_ms - self._connect_ms) if self._phase_scheme == "https" else 0.0
+        with _MIRROR_SESSIONS_LOCK:
+            _CONNECTION_PHASES.setdefault((self._phase_scheme, self.host.lower(), self.port), {
+                "dns_ms": self._dns_ms, "connect_ms": self._connect_ms, "tls_ms": tls_ms
+            })
+
+class _PhaseTimingHTTPConnection(_PhaseTimingConnectionMixin, HTTPConnection):
+    pass
+
+class _PhaseTimingHTTPSConnection(_PhaseTimingConnectionMixin, HTTPSConnection):
+    _phase_scheme = "https"
+
+class _PhaseTimingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _PhaseTimingHTTPConnection
+
+class _PhaseTimingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _PhaseTimingHTTPSConnection
+
+class _PhaseTimingAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools record the connection phases of each host's first connection."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _PhaseTimingHTTPConnectionPool,
+            "https": _PhaseTimingHTTPSConnectionPool
+        }
+
+def get_mirror_session(mirror_url):
+    """Return the shared keep-alive session for a mirror's host, creating it on first use."""
+    parsed = urlparse(mirror_url)
+    key = (parsed.scheme, parsed.netloc)
+    with _MIRROR_SESSIONS_LOCK:
+        session = _MIRROR_SESSIONS.get(key)
+        if session is None:
+            # One small connection pool per host, reused by every probe of that host
+            session = requests.Session()
+            adapter = _PhaseTimingAdapter(pool_connections=1, pool_maxsize=4)
+            session.mount(f"{parsed.scheme}://", adapter)
+            _MIRROR_SESSIONS[key] = session
+        return session
+
+def get_connection_phases(mirror_url):
+    """Return the DNS/connect/TLS times (ms) of the first pooled connection to a mirror's host, or {}."""
+    parsed = urlparse(mirror_url)
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+    with _MIRROR_SESSIONS_LOCK:
+        return dict(_CONNECTION_PHASES.get((parsed.scheme, (parsed.hostname or "").lower(), port), {}))
+
+def close_mirror_sessions():
+    """Close all pooled mirror sessions and their keep-alive connections."""
+    with _MIRROR_SESSIONS_LOCK:
+        for session in _MIRROR_SESSIONS.values():
+            session.close()
+        _MIRROR_SESSIONS.clear()
+        _CONNECTION_PHASES.clear()
+
 def check_mirror_reachable(mirror_url, timeout=5):
     """Check if a mirror URL is reachable and online."""
+    # Ensure URL ends with /
+    if not mirror_url.endswith('/'):
+        mirror_url = mirror_url + '/'
+    session = get_mirror_session(mirror_url)
+    
     try:
-        # Ensure URL ends with /
-        if not mirror_url.endswith('/'):
-            mirror_url = mirror_url + '/'
-        
         # Try to fetch a small file or HEAD request
-        response = requests.head(mirror_url, timeout=timeout, allow_redirects=True)
+        response = session.head(mirror_url, timeout=timeout, allow_redirects=True)
         if response.status_code < 400:
             return True
     except requests.exceptions.RequestException:
@@ -346,28 +613,43 @@ def check_mirror_reachable(mirror_url, timeout=5):
     
     # Fallback: try GET with a small timeout
     try:
-        response = requests.get(mirror_url, timeout=timeout, allow_redirects=True, stream=True)
-        if response.status_code < 400:
-            return True
+        with session.get(mirror_url, timeout=timeout, allow_redirects=True, stream=True) as response:
+            if response.status_code < 400:
+                return True
     except requests.exceptions.RequestException:
         pass
     
     return False
 
-def test_mirror_latency(mirror_url, test_cycles=3):
-    """Test mirror latency and return average latency, jitter, and success rate."""
+def _timed_head(mirror_url, timeout=5):
+    """HEAD a mirror on its keep-alive session, returning (response, time-to-first-byte in ms).
+
+    Timed with the monotonic perf_counter from sending the request until the
+    headers of the final response (after any redirect hops) have arrived.
+    """
+    start = time.perf_counter()
+    response = get_mirror_session(mirror_url).head(mirror_url, timeout=timeout, allow_redirects=True, stream=True)
+    ttfb = (time.perf_counter() - start) * 1000
+    # Consuming the (empty) body hands the connection back to the pool for the next sample
+    response.content
+    return response, ttfb
+
+def test_mirror_latency(mirror_url, test_cycles=5):
+    """Test mirror latency and return average latency, jitter, and success rate.
+
+    Samples reuse the host's keep-alive session, so latency is the steady-state
+    time-to-first-byte; connection setup is reported separately from the phases
+    of the first pooled connection.
+    """
     latencies = []
     failures = 0
     
     for cycle in range(test_cycles):
         try:
-            start_time = time.time()
-            response = requests.head(mirror_url, timeout=5, allow_redirects=True)
-            end_time = time.time()
+            response, ttfb = _timed_head(mirror_url)
             
             if response.status_code < 400:
-                latency = (end_time - start_time) * 1000  # Convert to milliseconds
-                latencies.append(latency)
+                latencies.append(ttfb)
             else:
                 failures += 1
         except requests.exceptions.RequestException:
@@ -377,6 +659,20 @@ def test_mirror_latency(mirror_url, test_cycles=3):
         if cycle < test_cycles - 1:
             time.sleep(0.5)
     
+    return _summarize_latencies(latencies, failures, get_connection_phases(mirror_url))
+
+def _percentile(values, pct):
+    """Return the pct-th percentile (0-100) of values using linear interpolation."""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+def _summarize_latencies(latencies, failures, phases=None):
+    """Build a latency test result from raw samples, or None if there are no successful samples."""
     if len(latencies) == 0:
         return None
     
@@ -396,86 +692,549 @@ def test_mirror_latency(mirror_url, test_cycles=3):
         jitter = 0
     
     success_rate = len(latencies) / (len(latencies) + failures)
+    phases = phases or {}
     
     return {
         "avg_latency": avg_latency,
+        "median_latency": _percentile(latencies, 50),
+        "p95_latency": _percentile(latencies, 95),
         "jitter": jitter,
         "success_rate": success_rate,
-        "latencies": latencies
+        "latencies": latencies,
+        "dns_ms": phases.get("dns_ms"),
+        "connect_ms": phases.get("connect_ms"),
+        "tls_ms": phases.get("tls_ms")
     }
 
+def sample_mirror_latency(mirror_url, timeout=5):
+    """Take a single keep-alive HEAD sample of a mirror, returning time-to-first-byte in ms or None."""
+    try:
+        response, ttfb = _timed_head(mirror_url, timeout)
+        if response.status_code < 400:
+            return ttfb
+    except requests.exceptions.RequestException:
+        pass
+    return None
+
+def _latency_interval(latencies):
+    """Return a rough (low, high) confidence interval for the median latency of a mirror."""
+    median = _percentile(latencies, 50)
+    if len(latencies) < 4:
+        # Too few samples for quartiles; use the observed spread with a 25% floor
+        spread = max(max(latencies) - min(latencies), median * 0.25)
+    else:
+        # Notch half-width used by box plots: 1.57 * IQR / sqrt(n)
+        iqr = _percentile(latencies, 75) - _percentile(latencies, 25)
+        spread = max(1.57 * iqr / len(latencies) ** 0.5, median * 0.05)
+    return median - spread, median + spread
+
+def run_mirror_tournament(mirrors, concurrency, deadline):
+    """Rank mirrors by successive halving, sampling only mirrors that can still win.
+
+    Returns a list of (mirror, test_result, error) tuples like probe_mirror.
+    """
+    keep_fraction = float(cfg_get("MIRROR_TOURNAMENT_KEEP", 0.5))
+    samples_per_round = max(1, int(cfg_get("MIRROR_TOURNAMENT_SAMPLES", 2)))
+    max_samples = max(1, int(cfg_get("MIRROR_TOURNAMENT_MAX_SAMPLES", 9)))
+    deadline_at = time.monotonic() + deadline
+    
+    samples = {mirror["url"]: [] for mirror in mirrors}
+    failures = {mirror["url"]: 0 for mirror in mirrors}
+    requests_sent = 0
+    
+    def sample(mirror):
+        return mirror["url"], sample_mirror_latency(mirror["url"])
+    
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        # Round one: a single cheap sample from every mirror
+        active = list(mirrors)
+        rounds = [1]
+        while active:
+            jobs = [executor.submit(sample, mirror) for mirror in active for _ in range(rounds[-1])]
+            requests_sent += len(jobs)
+            try:
+                for future in as_completed(jobs, timeout=max(0, deadline_at - time.monotonic())):
+                    url, latency = future.result()
+                    if latency is None:
+                        failures[url] += 1
+                    else:
+                        samples[url].append(latency)
+            except FuturesTimeoutError:
+                print(f"\033[93m⚠ WARNING: Mirror tournament deadline of {deadline:.0f}s reached\033[0m\n")
+                break
+            
+            # Mirrors that never answered are out; the rest are ordered by median latency
+            active = [m for m in active if samples[m["url"]]]
+            active.sort(key=lambda m: _percentile(samples[m["url"]], 50))
+            if len(active) <= 1:
+                break
+            
+            # Keep the top fraction, then drop any whose interval can't reach the leader's
+            survivors = active[:max(1, math.ceil(len(active) * keep_fraction))]
+            leader_high = _latency_interval(samples[survivors[0]["url"]])[1]
+            survivors = [m for m in survivors if _latency_interval(samples[m["url"]])[0] <= leader_high]
+            active = [m for m in survivors if len(samples[m["url"]]) + failures[m["url"]] < max_samples]
+            if len(survivors) <= 1:
+                break
+            rounds.append(samples_per_round)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    print(f"\033[96mℹ Tournament finished after {len(rounds)} rounds and {requests_sent} latency requests\033[0m\n")
+    
+    outcomes = []
+    for mirror in mirrors:
+        test_result = _summarize_latencies(samples[mirror["url"]], failures[mirror["url"]],
+                                           get_connection_phases(mirror["url"]))
+        error = None if test_result else "Mirror is unreachable or offline"
+        outcomes.append((mirror, test_result, error))
+    return outcomes
+
+def test_mirror_throughput(mirror_url, path, byte_count, max_seconds, timeout=10):
+    """Download up to byte_count bytes of a file on the mirror for at most max_seconds, returning MB/s."""
+    if not mirror_url.endswith('/'):
+        mirror_url = mirror_url + '/'
+    session = get_mirror_session(mirror_url)
+    headers = {"Range": f"bytes=0-{byte_count - 1}"}
+    received = 0
+    # No single connect or read may outlast the download's own time limit
+    timeout = min(timeout, max_seconds)
+    stop_at = time.perf_counter() + max_seconds
+    
+    try:
+        with session.get(mirror_url + path.lstrip('/'), headers=headers, timeout=timeout,
+                         allow_redirects=True, stream=True) as response:
+            if response.status_code not in (200, 206):
+                return None
+            # Time the body only, so connection setup and first byte don't count
+            start = time.perf_counter()
+            for chunk in response.iter_content(chunk_size=16384):
+                received += len(chunk)
+                # Servers that ignore Range send the whole file; stop at byte_count,
+                # and a slow mirror is rated on what arrived before the time limit
+                if received >= byte_count or time.perf_counter() >= stop_at:
+                    break
+            duration = time.perf_counter() - start
+    except requests.exceptions.RequestException:
+        return None
+    
+    if received == 0 or duration <= 0:
+        return None
+    return (received / (1024 * 1024)) / duration
+
+def rank_mirrors_by_throughput(results, deadline):
+    """Re-rank the top latency finalists by sustained download throughput, latency as a secondary term.
+
+    The finalists download in parallel for at most MIRROR_THROUGHPUT_SECONDS and
+    never past deadline, the seconds left of the analyzer's MIRROR_DEADLINE.
+    """
+    finalist_count = max(1, int(cfg_get("MIRROR_THROUGHPUT_FINALISTS", 5)))
+    path = cfg_get("MIRROR_THROUGHPUT_PATH", "snapshots/portage-latest.tar.xz")
+    byte_count = int(cfg_get("MIRROR_THROUGHPUT_BYTES", 4194304))
+    # Keep a fifth of the remaining deadline for connection setup and the last read
+    seconds = min(float(cfg_get("MIRROR_THROUGHPUT_SECONDS", 5)), deadline * 0.8)
+    finalists = results[:finalist_count]
+    
+    if seconds < 0.5:
+        print(f"\033[93m⚠ WARNING: Mirror analysis deadline reached, keeping the latency ranking\033[0m\n")
+        return results
+    
+    print(f"\033[96mℹ Measuring throughput of the top {len(finalists)} mirrors ({byte_count / (1024 * 1024):.1f} MB of {path}, up to {seconds:.0f}s)...\033[0m\n")
+    
+    executor = ThreadPoolExecutor(max_workers=len(finalists))
+    try:
+        futures = [executor.submit(test_mirror_throughput, r["url"], path, byte_count, seconds) for r in finalists]
+        wait(futures, timeout=deadline)
+        # Downloads still running at the deadline count as failed
+        speeds = [f.result() if f.done() else None for f in futures]
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    measured = []
+    unmeasured = []
+    for result, mbps in zip(finalists, speeds):
+        result["throughput_mbps"] = mbps
+        if mbps:
+            print(f"   \033[92m✓ {result['name']}: {mbps:.2f} MB/s\033[0m")
+            # Weight: time per MB 80%, latency score 20% (lower is better)
+            result["score"] = (1000 / mbps) * 0.8 + result["score"] * 0.2
+            measured.append(result)
+        else:
+            print(f"   \033[91m✗ {result['name']}: throughput test failed\033[0m")
+            unmeasured.append(result)
+    print()
+    
+    measured.sort(key=lambda x: x["score"])
+    return measured + unmeasured + results[finalist_count:]
+
+# Mirror table country codes that differ from the ISO 3166 codes used by zone.tab
+_COUNTRY_ALIASES = {"UK": "GB"}
+
+def build_mirror_region_index(mirrors):
+    """Index mirrors by country code, preserving table order within each country."""
+    index = {}
+    for mirror in mirrors:
+        index.setdefault(mirror.get("country", "Unknown"), []).append(mirror)
+    return index
+
+def _parse_zone_coordinate(text, degree_digits):
+    """Convert a zone.tab coordinate like +4426 or -0740023 to decimal degrees."""
+    sign = -1 if text[0] == "-" else 1
+    digits = text[1:]
+    degrees = int(digits[:degree_digits])
+    minutes = int(digits[degree_digits:degree_digits + 2])
+    seconds = int(digits[degree_digits + 2:] or 0)
+    return sign * (degrees + minutes / 60 + seconds / 3600)
+
+def load_zone_coordinates(zone_tab="/usr/share/zoneinfo/zone.tab"):
+    """Read zone.tab, returning ({zone: (country, lat, lon)}, {country: (lat, lon)})."""
+    zones = {}
+    countries = {}
+    try:
+        with open(zone_tab, encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                fields = line.split("\t")
+                if len(fields) < 3:
+                    continue
+                country, coordinates, zone = fields[0], fields[1], fields[2].strip()
+                match = re.match(r"([+-]\d+)([+-]\d+)$", coordinates)
+                if not match:
+                    continue
+                lat = _parse_zone_coordinate(match.group(1), 2)
+                lon = _parse_zone_coordinate(match.group(2), 3)
+                zones[zone] = (country, lat, lon)
+                # The first zone listed for a country stands in for the whole country
+                countries.setdefault(country, (lat, lon))
+    except OSError:
+        pass
+    return zones, countries
+
+def _distance_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * math.asin(math.sqrt(a))
+
+def prefilter_mirrors_by_region(mirrors, zoneinfo):
+    """Split mirrors into search tiers, nearest to the configured ZONEINFO first.
+
+    Returns a list of mirror lists; a single tier holding every mirror when the
+    prefilter is disabled or the timezone can't be located.
+    """
+    if not cfg_get("MIRROR_GEO_PREFILTER", True):
+        return [mirrors]
+    
+    zones, countries = load_zone_coordinates()
+    if zoneinfo not in zones:
+        print(f"\033[93m⚠ WARNING: Could not locate timezone '{zoneinfo}' in zone.tab, probing all mirrors\033[0m")
+        return [mirrors]
+    _, home_lat, home_lon = zones[zoneinfo]
+    
+    def country_distance(country):
+        coordinates = countries.get(_COUNTRY_ALIASES.get(country, country))
+        if coordinates is None:
+            return float("inf")
+        return _distance_km(home_lat, home_lon, *coordinates)
+    
+    # Whole countries are added nearest-first until each tier holds its share of mirrors
+    index = build_mirror_region_index(mirrors)
+    ordered = sorted(index, key=country_distance)
+    tier_size = max(1, int(cfg_get("MIRROR_GEO_NEARBY", 15)))
+    tiers = [[]]
+    for country in ordered:
+        if len(tiers[-1]) >= tier_size:
+            tiers.append([])
+            # Each wider radius probes twice as many mirrors as the previous one
+            tier_size *= 2
+        tiers[-1].extend(index[country])
+    return tiers
+
+def _load_mirror_cache():
+    """Load the on-disk mirror measurement cache, returning {} if missing or corrupt."""
+    try:
+        with open(MIRROR_CACHE_FILE, encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def _save_mirror_cache(cache):
+    """Atomically write the mirror measurement cache."""
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=".mirror_cache.",
+                                        dir=os.path.dirname(os.path.abspath(MIRROR_CACHE_FILE)))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, MIRROR_CACHE_FILE)
+    except OSError as e:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"\033[93m⚠ WARNING: Could not write mirror cache {MIRROR_CACHE_FILE}: {e}\033[0m")
+
+def get_fresh_mirror_entry(cache, mirror_url):
+    """Return the cached measurement for a mirror if it succeeded and is still within MIRROR_CACHE_TTL."""
+    entry = cache.get(mirror_url)
+    if not entry or entry.get("error") or not entry.get("test_result"):
+        return None
+    ttl = float(cfg_get("MIRROR_CACHE_TTL", 21600))
+    if time.time() - entry.get("measured_at", 0) > ttl:
+        return None
+    return entry
+
+def probe_mirror(mirror, test_cycles=5):
+    """Check reachability and latency of a single mirror, returning (mirror, test_result, error)."""
+    mirror_url = mirror["url"]
+    
+    # Check if reachable first
+    if not check_mirror_reachable(mirror_url):
+        return mirror, None, "Mirror is unreachable or offline"
+    
+    # Test latency
+    test_result = test_mirror_latency(mirror_url, test_cycles=test_cycles)
+    if test_result is None:
+        return mirror, None, "Failed to get latency data"
+    
+    return mirror, test_result, None
+
+def score_latency_result(test_result, robust=False):
+    """Calculate a mirror's quality score from its latency test result (lower is better)."""
+    success_rate = test_result["success_rate"]
+    if robust and test_result.get("median_latency") is not None:
+        median_latency = test_result["median_latency"]
+        p95_latency = test_result["p95_latency"]
+        # Weight: median 60%, p95 tail 20%, success_rate 20%
+        return (median_latency * 0.6) + ((p95_latency - median_latency) * 0.2) + ((1 - success_rate) * 1000 * 0.2)
+    # Weight: latency 60%, jitter 20%, success_rate 20%
+    return (test_result["avg_latency"] * 0.6) + (test_result["jitter"] * 0.2) + ((1 - success_rate) * 1000 * 0.2)
+
+def _report_mirror(idx, total_mirrors, mirror, test_result, error, source="Tested", robust=False):
+    """Print one mirror's measurements and return its scored result, or None if it failed.
+
+    With robust=True the score uses the median and p95 latency instead of mean and jitter.
+    """
+    mirror_url = mirror["url"]
+    mirror_name = mirror["name"]
+    mirror_country = mirror.get("country", "Unknown")
+    mirror_protocol = mirror.get("protocol", "https")
+    mirror_ipv6 = mirror.get("ipv6", False)
+    
+    print(f"\033[96mℹ [{idx}/{total_mirrors}] {source}: {mirror_name}\033[0m")
+    print(f"   \033[93m📍 Location: {mirror_country}\033[0m")
+    print(f"   \033[93m🔗 Protocol: {mirror_protocol.upper()}\033[0m")
+    print(f"   \033[93m🌐 IPv6 Support: {'Yes' if mirror_ipv6 else 'No'}\033[0m")
+    print(f"   \033[93m🔗 URL: {mirror_url}\033[0m")
+    
+    if error:
+        print(f"   \033[91m✗ {error}\033[0m\n")
+        return None
+    
+    avg_latency = test_result["avg_latency"]
+    jitter = test_result["jitter"]
+    success_rate = test_result["success_rate"]
+    
+    if test_result.get("connect_ms") is not None:
+        print(f"   \033[92m✓ Connection setup: DNS {test_result['dns_ms']:.2f}ms, "
+              f"connect {test_result['connect_ms']:.2f}ms, TLS {test_result['tls_ms'] or 0:.2f}ms\033[0m")
+    print(f"   \033[92m✓ Average latency: {avg_latency:.2f}ms\033[0m")
+    print(f"   \033[92m✓ Jitter: {jitter:.2f}ms\033[0m")
+    print(f"   \033[92m✓ Success rate: {success_rate*100:.1f}%\033[0m")
+    
+    if robust and test_result.get("median_latency") is not None:
+        print(f"   \033[92m✓ Median latency: {test_result['median_latency']:.2f}ms "
+              f"(p95 {test_result['p95_latency']:.2f}ms, {len(test_result['latencies'])} samples)\033[0m")
+    score = score_latency_result(test_result, robust)
+    
+    print(f"   \033[93mℹ Quality score: {score:.2f}\033[0m\n")
+    
+    return {
+        "url": mirror_url,
+        "name": mirror_name,
+        "country": mirror_country,
+        "protocol": mirror_protocol,
+        "ipv6": mirror_ipv6,
+        "avg_latency": avg_latency,
+        "jitter": jitter,
+        "success_rate": success_rate,
+        "score": score
+    }
+
+def _measure_mirrors(mirrors, cache, concurrency, deadline, tournament):
+    """Measure a batch of mirrors, reusing fresh cache entries, and return their scored results."""
+    cached = []
+    to_probe = []
+    for mirror in mirrors:
+        entry = get_fresh_mirror_entry(cache, mirror["url"])
+        if entry:
+            cached.append((mirror, entry["test_result"]))
+        else:
+            to_probe.append(mirror)
+    
+    if cached:
+        print(f"\033[96mℹ Reusing {len(cached)} recent measurements from {MIRROR_CACHE_FILE}\033[0m")
+    print(f"\033[96mℹ Probing {len(to_probe)} mirrors, up to {concurrency} at once (deadline: {deadline:.0f}s). Testing latency and reliability...\033[0m\n")
+    
+    results = []
+    total_mirrors = len(mirrors)
+    idx = 0
+    
+    def record(mirror, test_result, error):
+        cache[mirror["url"]] = {
+            "measured_at": time.time(),
+            "test_result": test_result,
+            "error": error
+        }
+        return _report_mirror(idx, total_mirrors, mirror, test_result, error, robust=tournament)
+    
+    for mirror, test_result in cached:
+        idx += 1
+        result = _report_mirror(idx, total_mirrors, mirror, test_result, None, source="Cached", robust=tournament)
+        if result:
+            results.append(result)
+    
+    if tournament and to_probe:
+        # Successive halving: sample counts adapt to how close each mirror is to winning
+        for mirror, test_result, error in run_mirror_tournament(to_probe, concurrency, deadline):
+            idx += 1
+            result = record(mirror, test_result, error)
+            if result:
+                results.append(result)
+    else:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = [executor.submit(probe_mirror, mirror, 5) for mirror in to_probe]
+        try:
+            for future in as_completed(futures, timeout=deadline):
+                idx += 1
+                # Report each mirror in one block once its probe has finished
+                result = record(*future.result())
+                if result:
+                    results.append(result)
+        except FuturesTimeoutError:
+            print(f"\033[93m⚠ WARNING: Mirror analysis deadline of {deadline:.0f}s reached, {total_mirrors - idx} mirrors skipped\033[0m\n")
+        finally:
+            # Don't wait for stragglers past the deadline
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    if to_probe:
+        _save_mirror_cache(cache)
+    
+    return results
+
+# Two-label public suffixes under which mirror operators register their domains;
+# anything else is treated as registrable directly below its top-level domain
+_PUBLIC_SUFFIXES = frozenset({
+    "ac.at", "co.at", "or.at",
+    "com.au", "edu.au", "net.au", "org.au",
+    "com.br", "edu.br", "net.br", "org.br",
+    "ac.cn", "com.cn", "edu.cn", "net.cn", "org.cn",
+    "com.hk", "edu.hk", "net.hk", "org.hk",
+    "ac.id", "co.id",
+    "ac.il", "co.il", "net.il", "org.il",
+    "ac.in", "co.in", "net.in", "org.in",
+    "ac.jp", "ad.jp", "co.jp", "ne.jp", "or.jp",
+    "ac.kr", "co.kr", "ne.kr", "or.kr",
+    "com.mx", "edu.mx",
+    "ac.nz", "co.nz", "net.nz", "org.nz",
+    "ac.th", "co.th",
+    "com.tr", "edu.tr", "net.tr", "org.tr",
+    "com.tw", "edu.tw", "net.tw", "org.tw",
+    "com.ua", "net.ua", "org.ua",
+    "ac.uk", "co.uk", "org.uk",
+    "ac.za", "co.za", "org.za",
+})
+
+def _mirror_network(hostname):
+    """Approximate the network a mirror host belongs to by its registrable domain."""
+    labels = (hostname or "").lower().split(".")
+    # IPv4 addresses are grouped by their /24
+    if len(labels) == 4 and all(label.isdigit() for label in labels):
+        return ".".join(labels[:3])
+    # Keep a third label below country second-level domains like edu.cn or co.uk
+    if len(labels) >= 3 and ".".join(labels[-2:]) in _PUBLIC_SUFFIXES:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+def select_failover_mirrors(results, count):
+    """Pick up to count mirror URLs in score order, spreading them across hosts and networks."""
+    selected = []
+    hosts = set()
+    networks = set()
+    # First pass takes one mirror per network, second pass fills up with the best leftovers
+    for distinct in (True, False):
+        for result in results:
+            if len(selected) >= count:
+                return selected
+            host = mirror_host_key(result["url"])
+            network = _mirror_network(urlparse(result["url"]).hostname)
+            if result["url"] in selected or host in hosts:
+                continue
+            if distinct and network in networks:
+                continue
+            selected.append(result["url"])
+            hosts.add(host)
+            networks.add(network)
+    return selected
+
 def analyze_and_select_best_mirror():
-    """Analyze all mirrors and select the best one based on latency, jitter, and reliability."""
+    """Analyze all mirrors and rank them based on latency, jitter, and reliability.
+
+    Returns up to MIRROR_FAILOVER_COUNT mirror URLs in failover order, or None.
+    """
     print(f"\033[1m\033[94m{'='*70}\033[0m")
     print(f"\033[1m\033[94mGENTOO MIRROR ANALYZER - Finding Best Mirror\033[0m")
     print(f"\033[1m\033[94m{'='*70}\033[0m\n")
     
-    print(f"\033[96mℹ Analyzing {len(GENTOO_MIRRORS)} mirrors from official Gentoo mirror list\033[0m")
-    print(f"\033[96mℹ Source: https://www.gentoo.org/downloads/mirrors/\033[0m")
-    print(f"\033[96mℹ This may take a few minutes. Testing latency and reliability...\033[0m\n")
+    # Mirrors are probed in parallel, bounded by a worker cap and an overall deadline
+    concurrency = max(1, int(cfg_get("MIRROR_CONCURRENCY", 16)))
+    deadline = float(cfg_get("MIRROR_DEADLINE", 60))
+    tournament = cfg_get("MIRROR_SAMPLING", "fixed") == "tournament"
+    max_nearby_score = float(cfg_get("MIRROR_GEO_MAX_SCORE", 150))
+    deadline_at = time.monotonic() + deadline
+    
+    # Reuse recent successful measurements; only stale or failed mirrors are re-probed
+    cache = _load_mirror_cache()
+    registry = get_mirror_registry()
+    hosts = registry.hosts()
+    tiers = prefilter_mirrors_by_region(hosts, cfg_get("ZONEINFO", ""))
+    
+    print(f"\033[96mℹ Analyzing {len(registry.mirrors)} mirrors on {len(hosts)} hosts from {registry.source}\033[0m")
+    if registry.source == "built-in mirror list":
+        print(f"\033[96mℹ Source: https://www.gentoo.org/downloads/mirrors/\033[0m")
     
     results = []
-    total_mirrors = len(GENTOO_MIRRORS)
-    
-    for idx, mirror in enumerate(GENTOO_MIRRORS, 1):
-        mirror_url = mirror["url"]
-        mirror_name = mirror["name"]
-        mirror_country = mirror.get("country", "Unknown")
-        mirror_protocol = mirror.get("protocol", "https")
-        mirror_ipv6 = mirror.get("ipv6", False)
-        
-        print(f"\033[96mℹ [{idx}/{total_mirrors}] Testing: {mirror_name}\033[0m")
-        print(f"   \033[93m📍 Location: {mirror_country}\033[0m")
-        print(f"   \033[93m🔗 Protocol: {mirror_protocol.upper()}\033[0m")
-        print(f"   \033[93m🌐 IPv6 Support: {'Yes' if mirror_ipv6 else 'No'}\033[0m")
-        print(f"   \033[93m🔗 URL: {mirror_url}\033[0m")
-        
-        # Check if reachable first
-        if not check_mirror_reachable(mirror_url):
-            print(f"   \033[91m✗ Mirror is unreachable or offline\033[0m\n")
-            continue
-        
-        print(f"   \033[92m✓ Mirror is online, testing latency...\033[0m")
-        
-        # Test latency
-        test_result = test_mirror_latency(mirror_url, test_cycles=5)
+    for tier_number, tier in enumerate(tiers, 1):
+        if len(tiers) > 1:
+            countries = ", ".join(sorted({m.get("country", "Unknown") for m in tier}))
+            print(f"\033[96mℹ Search radius {tier_number}/{len(tiers)}: {len(tier)} mirrors ({countries})\033[0m")
+        results += _measure_mirrors(tier, cache, concurrency, max(0, deadline_at - time.monotonic()), tournament)
         
-        if test_result is None:
-            print(f"   \033[91m✗ Failed to get latency data\033[0m\n")
-            continue
-        
-        avg_latency = test_result["avg_latency"]
-        jitter = test_result["jitter"]
-        success_rate = test_result["success_rate"]
-        
-        print(f"   \033[92m✓ Average latency: {avg_latency:.2f}ms\033[0m")
-        print(f"   \033[92m✓ Jitter: {jitter:.2f}ms\033[0m")
-        print(f"   \033[92m✓ Success rate: {success_rate*100:.1f}%\033[0m")
-        
-        # Calculate score (lower is better)
-        # Weight: latency 60%, jitter 20%, success_rate 20%
-        score = (avg_latency * 0.6) + (jitter * 0.2) + ((1 - success_rate) * 1000 * 0.2)
-        
-        results.append({
-            "url": mirror_url,
-            "name": mirror_name,
-            "country": mirror_country,
-            "protocol": mirror_protocol,
-            "ipv6": mirror_ipv6,
-            "avg_latency": avg_latency,
-            "jitter": jitter,
-            "success_rate": success_rate,
-            "score": score
-        })
-        
-        print(f"   \033[93mℹ Quality score: {score:.2f}\033[0m\n")
+        # Only widen the search if nothing nearby works well enough
+        if results and min(r["score"] for r in results) <= max_nearby_score:
+            break
+        if tier_number < len(tiers):
+            print(f"\033[93m⚠ No nearby mirror scored {max_nearby_score:.0f} or better, widening the search...\033[0m\n")
     
     if len(results) == 0:
         print(f"\033[91m✗ ERROR: No working mirrors found!\033[0m")
+        close_mirror_sessions()
         return None
     
     # Sort by score (lower is better)
     results.sort(key=lambda x: x["score"])
+    
+    # In throughput mode the latency ranking only picks the finalists, one per host
+    if cfg_get("MIRROR_RANKING", "latency") == "throughput":
+        results = rank_mirrors_by_throughput(results, max(0, deadline_at - time.monotonic()))
+    
+    # Each host was probed once; its other protocol variants share the result and
+    # are listed right after it, so the final order is kept
+    results = registry.expand_results(results)
+    
+    # Release the probes' keep-alive connections
+    close_mirror_sessions()
     best_mirror = results[0]
     
     print(f"\033[1m\033[94m{'='*70}\033[0m")
@@ -493,19 +1252,48 @@ def analyze_and_select_best_mirror():
     print(f"   Average Latency: {best_mirror['avg_latency']:.2f}ms")
     print(f"   Jitter: {best_mirror['jitter']:.2f}ms")
     print(f"   Success Rate: {best_mirror['success_rate']*100:.1f}%")
+    if best_mirror.get("throughput_mbps"):
+        print(f"   Throughput: {best_mirror['throughput_mbps']:.2f} MB/s")
     print(f"   Quality Score: {best_mirror['score']:.2f}\n")
     
     if len(results) > 1:
         print(f"\033[96mℹ Top 3 mirrors:\033[0m")
         for i, result in enumerate(results[:3], 1):
             country_info = f" ({result.get('country', 'Unknown')})" if result.get('country') else ""
-            print(f"   {i}. {result['name']}{country_info} - {result['avg_latency']:.2f}ms avg")
+            throughput_info = f", {result['throughput_mbps']:.2f} MB/s" if result.get("throughput_mbps") else ""
+            print(f"   {i}. {result['name']}{country_info} - {result['avg_latency']:.2f}ms avg{throughput_info}")
         print()
     
-    return best_mirror["url"]
+    # Ranked mirrors for GENTOO_MIRRORS, one per host and preferably per network
+    mirror_urls = select_failover_mirrors(results, max(1, int(cfg_get("MIRROR_FAILOVER_COUNT", 3))))
+    print(f"\033[96mℹ Failover order for GENTOO_MIRRORS:\033[0m")
+    for i, url in enumerate(mirror_urls, 1):
+        print(f"   {i}. {url}")
+    print()
+    
+    return mirror_urls
+
+def _auto_select_mirrors():
+    """Run the mirror analyzer and store the ranked result in MIRROR and MIRROR_FAILOVER."""
+    print(f"\033[96mℹ Triggering automatic mirror selection...\033[0m\n")
+    mirror_urls = analyze_and_select_best_mirror()
+    if mirror_urls:
+        cfg_set("MIRROR", mirror_urls[0])
+        cfg_set("MIRROR_FAILOVER", mirror_urls[1:])
+        print(f"\033[92m✓ MIRROR automatically set to: {mirror_urls[0]}\033[0m")
+        if len(mirror_urls) > 1:
+            print(f"\033[92m✓ Failover mirrors: {' '.join(mirror_urls[1:])}\033[0m")
+        print()
+        return mirror_urls
+    else:
+        print(f"\033[91m✗ ERROR: Could not find a working mirror!\033[0m")
+        return None
 
 def validate_and_set_mirror():
-    """Validate the MIRROR config value and auto-select if invalid."""
+    """Validate the MIRROR config value and auto-select if invalid.
+
+    Returns the mirror URLs in failover order (configured or best mirror first), or None.
+    """
     print(f"\033[1m\033[94m{'='*70}\033[0m")
     print(f"\033[1m\033[94mMIRROR VALIDATION AND CONFIGURATION\033[0m")
     print(f"\033[1m\033[94m{'='*70}\033[0m\n")
@@ -515,61 +1303,1231 @@ def validate_and_set_mirror():
     # Check if MIRROR is blank or invalid
     if not current_mirror or current_mirror.strip() == "":
         print(f"\033[93m⚠ MIRROR value is empty or blank\033[0m")
-        print(f"\033[96mℹ Triggering automatic mirror selection...\033[0m\n")
-        best_mirror = analyze_and_select_best_mirror()
-        if best_mirror:
-            cfg_set("MIRROR", best_mirror)
-            print(f"\033[92m✓ MIRROR automatically set to: {best_mirror}\033[0m\n")
-            return best_mirror
-        else:
-            print(f"\033[91m✗ ERROR: Could not find a working mirror!\033[0m")
-            return None
+        return _auto_select_mirrors()
     
     # Check if it looks like a valid URL
     try:
         parsed = urlparse(current_mirror)
         if not parsed.scheme or not parsed.netloc:
             print(f"\033[93m⚠ MIRROR value doesn't look like a valid URL: {current_mirror}\033[0m")
-            print(f"\033[96mℹ Triggering automatic mirror selection...\033[0m\n")
-            best_mirror = analyze_and_select_best_mirror()
-            if best_mirror:
-                cfg_set("MIRROR", best_mirror)
-                print(f"\033[92m✓ MIRROR automatically set to: {best_mirror}\033[0m\n")
-                return best_mirror
-            else:
-                print(f"\033[91m✗ ERROR: Could not find a working mirror!\033[0m")
-                return None
+            return _auto_select_mirrors()
     except Exception:
         print(f"\033[93m⚠ MIRROR value appears invalid: {current_mirror}\033[0m")
-        print(f"\033[96mℹ Triggering automatic mirror selection...\033[0m\n")
-        best_mirror = analyze_and_select_best_mirror()
-        if best_mirror:
-            cfg_set("MIRROR", best_mirror)
-            print(f"\033[92m✓ MIRROR automatically set to: {best_mirror}\033[0m\n")
-            return best_mirror
-        else:
-            print(f"\033[91m✗ ERROR: Could not find a working mirror!\033[0m")
-            return None
+        return _auto_select_mirrors()
     
     # Validate that the mirror is reachable
     print(f"\033[96mℹ Validating configured mirror: {current_mirror}\033[0m")
     print(f"\033[96mℹ Checking if mirror is online and reachable...\033[0m")
     
-    if check_mirror_reachable(current_mirror):
+    # Keep the failover mirrors from the last analysis behind the configured one
+    mirror_urls = [current_mirror] + [url for url in cfg_get("MIRROR_FAILOVER", []) if url != current_mirror]
+    
+    representative = get_mirror_registry().representative(current_mirror)
+    cached_url = representative["url"] if representative else current_mirror
+    if get_fresh_mirror_entry(_load_mirror_cache(), cached_url):
+        print(f"\033[92m✓ Mirror was measured recently and is reachable (from {MIRROR_CACHE_FILE})\033[0m")
+        print(f"\033[92m✓ Using configured mirror: {current_mirror}\033[0m\n")
+        return mirror_urls
+    elif check_mirror_reachable(current_mirror):
         print(f"\033[92m✓ Mirror is online and reachable!\033[0m")
         print(f"\033[92m✓ Using configured mirror: {current_mirror}\033[0m\n")
-        return current_mirror
+        return mirror_urls
     else:
         print(f"\033[91m✗ Mirror is unreachable or offline\033[0m")
-        print(f"\033[96mℹ Triggering automatic mirror selection...\033[0m\n")
-        best_mirror = analyze_and_select_best_mirror()
-        if best_mirror:
-            cfg_set("MIRROR", best_mirror)
-            print(f"\033[92m✓ MIRROR automatically set to: {best_mirror}\033[0m\n")
-            return best_mirror
+        return _auto_select_mirrors()
+
+def set_make_conf_mirrors(mirror_urls, make_conf_path="/etc/portage/make.conf"):
+    """Atomically replace the GENTOO_MIRRORS line in make.conf with mirror_urls in order."""
+    set_make_conf_var("GENTOO_MIRRORS", " ".join(mirror_urls), make_conf_path)
+
+def set_make_conf_var(name, value, make_conf_path="/etc/portage/make.conf"):
+    """Atomically replace any assignment of name in make.conf with name="value"."""
+    with _PORTAGE_CONFIG_LOCK:
+        with open(make_conf_path, "r") as f:
+            lines = f.readlines()
+        
+        # Remove any existing assignment and add the new one
+        lines = [line for line in lines if not line.strip().startswith(f"{name}=")]
+        lines.append(f'{name}="{value}"\n')
+        
+        # Write to a temporary file first so emerge never reads a half-written make.conf
+        fd, tmp_path = tempfile.mkstemp(prefix=".make.conf.", dir=os.path.dirname(os.path.abspath(make_conf_path)))
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.writelines(lines)
+            os.chmod(tmp_path, os.stat(make_conf_path).st_mode & 0o7777)
+            os.replace(tmp_path, make_conf_path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+class MirrorHealthMonitor:
+    """Background thread that re-samples the configured mirrors and reorders GENTOO_MIRRORS.
+
+    make.conf is only rewritten when a different mirror beats the current first
+    choice by more than MIRROR_MONITOR_THRESHOLD, or the first choice stops
+    answering. The file is replaced atomically, so emerge invocations started
+    afterwards pick up the new order without ever reading a partial file.
+    """
+    
+    def __init__(self, mirror_urls, make_conf_path="/etc/portage/make.conf"):
+        self.mirror_urls = list(mirror_urls)
+        self.make_conf_path = make_conf_path
+        self.interval = float(cfg_get("MIRROR_MONITOR_INTERVAL", 300))
+        self.threshold = float(cfg_get("MIRROR_MONITOR_THRESHOLD", 0.3))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mirror-monitor", daemon=True)
+    
+    def start(self):
+        """Start monitoring in the background."""
+        if len(self.mirror_urls) > 1:
+            self._thread.start()
+    
+    def stop(self):
+        """Stop monitoring and wait for an in-progress check to finish."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"\033[93m⚠ WARNING: [mirror monitor] Check failed: {e}\033[0m")
+    
+    def check(self):
+        """Re-sample all mirrors once and rewrite make.conf if the ranking changed significantly."""
+        scores = {}
+        for url in self.mirror_urls:
+            test_result = test_mirror_latency(url, test_cycles=3)
+            scores[url] = score_latency_result(test_result) if test_result else None
+        
+        # Unreachable mirrors sort last, keeping their previous relative order
+        ranked = sorted(self.mirror_urls, key=lambda url: float("inf") if scores[url] is None else scores[url])
+        current, best = self.mirror_urls[0], ranked[0]
+        if best == current or scores[best] is None:
+            return False
+        if scores[current] is not None and scores[best] >= scores[current] * (1 - self.threshold):
+            return False
+        
+        set_make_conf_mirrors(ranked, self.make_conf_path)
+        self.mirror_urls = ranked
+        print(f"\033[96mℹ [mirror monitor] {best} is now faster than {current}, GENTOO_MIRRORS reordered\033[0m")
+        return True
+
+def stage3_source_urls(base_url, filename, mirror_urls):
+    """Return download URLs for a stage3 file: base_url first, then each mirror's copy of it."""
+    if not base_url.endswith('/'):
+        base_url = base_url + '/'
+    urls = [base_url + filename]
+    
+    # Mirrors carry the same releases/ tree as the host in the stage3 index URL
+    path = urlparse(base_url).path
+    if "/releases/" not in path:
+        return urls
+    relative_path = path[path.index("/releases/") + 1:]
+    for mirror_url in mirror_urls:
+        if not mirror_url:
+            continue
+        if not mirror_url.endswith('/'):
+            mirror_url = mirror_url + '/'
+        url = mirror_url + relative_path + filename
+        if url not in urls:
+            urls.append(url)
+    return urls
+
+def _probe_download_source(url, timeout=5):
+    """HEAD a download source, returning (size, accepts_ranges, validator) or None if unusable.
+
+    validator is the ETag, or failing that the Last-Modified date, or "" if the source sends neither.
+    """
+    try:
+        response = get_mirror_session(url).head(url, timeout=timeout, allow_redirects=True)
+        if response.status_code >= 400:
+            return None
+        size = int(response.headers.get("Content-Length", 0))
+        accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified") or ""
+        return (size, accepts_ranges, validator) if size > 0 else None
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+def _fetch_range(url, start, end, cancelled=None, timeout=30):
+    """Download bytes start..end (inclusive) of url, returning the data or None.
+
+    Gives up early, returning None, once cancelled() reports the range is no longer needed.
+    """
+    chunks = []
+    received = 0
+    try:
+        with get_mirror_session(url).get(url, headers={"Range": f"bytes={start}-{end}"}, timeout=timeout,
+                                         allow_redirects=True, stream=True) as response:
+            if response.status_code != 206:
+                return None
+            for chunk in response.iter_content(chunk_size=65536):
+                if cancelled and cancelled():
+                    return None
+                chunks.append(chunk)
+                received += len(chunk)
+    except requests.exceptions.RequestException:
+        return None
+    if received != end - start + 1:
+        return None
+    return b"".join(chunks)
+
+def download_state_path(dest_path):
+    """Return the path of the resume state kept next to a partially downloaded file."""
+    return dest_path + ".download.json"
+
+def _load_download_state(dest_path):
+    """Load the resume state for dest_path, returning None if missing or corrupt."""
+    try:
+        with open(download_state_path(dest_path), encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else None
+    except (OSError, ValueError):
+        return None
+
+def _save_download_state(dest_path, state):
+    """Atomically write the resume state for dest_path."""
+    state_path = download_state_path(dest_path)
+    with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+def _resumable_segments(dest_path, state, size, segment_size, validators):
+    """Return the segments already on disk if state still describes the same remote file, else None.
+
+    The file must have the recorded size and segmenting, and every source seen in both
+    runs must still report the same ETag/Last-Modified; with no such source the
+    partial data can't be trusted.
+    """
+    if not state or state.get("size") != size or state.get("segment_size") != segment_size:
+        return None
+    if not os.path.isfile(dest_path) or os.path.getsize(dest_path) != size:
+        return None
+    recorded = state.get("validators", {})
+    shared = [url for url in validators if url in recorded]
+    if not shared or any(recorded[url] != validators[url] for url in shared):
+        return None
+    return set(state.get("done", []))
+
+# Out-of-order segment data held in memory for in-order hashing before falling back to re-reads
+_HASH_HOLD_BYTES = 64 * 1024 * 1024
+
+def download_segmented(urls, dest_path, hasher=None):
+    """Download a file as HTTP Range segments fetched concurrently from several sources.
+
+    Segments are handed out from a shared queue, so faster sources take more of
+    them; sources that fail repeatedly or fall far behind the fastest one stop
+    receiving work, and idle connections re-fetch the last outstanding segments.
+    Finished segments are recorded next to dest_path, so an interrupted download
+    resumes where it stopped as long as the sources' ETag/Last-Modified is unchanged.
+    If hasher (e.g. hashlib.sha512()) is given, it is fed the file's bytes in order as
+    segments arrive, so the digest is ready without re-reading the file.
+    Returns True when every byte was written to dest_path.
+    """
+    connections = max(1, int(cfg_get("DOWNLOAD_CONNECTIONS", 8)))
+    segment_size = max(1, int(cfg_get("DOWNLOAD_SEGMENT_MB", 8))) * 1024 * 1024
+    slow_ratio = float(cfg_get("DOWNLOAD_SLOW_RATIO", 0.25))
+    
+    # Only sources that support ranges and agree on the size can share the work
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        probes = dict(zip(urls, executor.map(_probe_download_source, urls)))
+    usable = [url for url in urls if probes[url] and probes[url][1]]
+    if not usable:
+        print(f"\033[93m⚠ WARNING: No download source supports range requests\033[0m")
+        return False
+    size = probes[usable[0]][0]
+    sources = [url for url in usable if probes[url][0] == size]
+    
+    segments = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+    validators = {url: probes[url][2] for url in sources if probes[url][2]}
+    done = _resumable_segments(dest_path, _load_download_state(dest_path), size, segment_size, validators)
+    resuming = done is not None
+    done = {idx for idx in done if 0 <= idx < len(segments)} if resuming else set()
+    written = sorted(done)
+    resumed = frozenset(done)
+    pending = deque(idx for idx in range(len(segments)) if idx not in done)
+    fetchers = {}
+    stats = {url: {"bytes": 0, "seconds": 0.0, "failures": 0, "retired": False} for url in sources}
+    lock = threading.Lock()
+    state = {"size": size, "segment_size": segment_size, "validators": validators, "done": written}
+    
+    if resuming:
+        print(f"\033[96mℹ Resuming download: {len(done)} of {len(segments)} segments already on disk\033[0m")
+    print(f"\033[96mℹ Downloading {size / (1024 * 1024):.1f} MB in {len(segments)} segments from {len(sources)} sources ({connections} connections)\033[0m")
+    for url in sources:
+        print(f"   \033[93m🔗 {url}\033[0m")
+    
+    # Preallocate so segments can be written in place at their offsets
+    fd = os.open(dest_path, os.O_RDWR | os.O_CREAT | (0 if resuming else os.O_TRUNC), 0o644)
+    try:
+        if not resuming:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        if validators:
+            _save_download_state(dest_path, state)
+        
+        # Segments finish out of order; hold them until the hasher reaches them.
+        # Past the memory limit only their index is kept and the bytes are re-read
+        # from the (still cached) file when their turn comes
+        hashing = {"next": 0, "held": {}, "held_bytes": 0}
+        hash_lock = threading.Lock()
+        
+        def hash_segment(idx):
+            start, end = segments[idx]
+            data = hashing["held"].pop(idx, None)
+            if data is None:
+                data = os.pread(fd, end - start + 1, start)
+            else:
+                hashing["held_bytes"] -= len(data)
+            hasher.update(data)
+        
+        def hash_in_order(idx, data):
+            with hash_lock:
+                if hashing["held_bytes"] + len(data) <= _HASH_HOLD_BYTES:
+                    hashing["held"][idx] = data
+                    hashing["held_bytes"] += len(data)
+                else:
+                    hashing["held"][idx] = None
+                while hashing["next"] in hashing["held"] or hashing["next"] in resumed:
+                    hash_segment(hashing["next"])
+                    hashing["next"] += 1
+        
+        def record(idx, data, start):
+            # Only mark a segment finished once its bytes are written
+            os.pwrite(fd, data, start)
+            if hasher is not None:
+                hash_in_order(idx, data)
+            if not validators:
+                return
+            with lock:
+                written.append(idx)
+                _save_download_state(dest_path, state)
+        
+        def rate(url):
+            s = stats[url]
+            return s["bytes"] / s["seconds"] if s["seconds"] else 0
+        
+        def next_segment(url):
+            with lock:
+                if stats[url]["retired"]:
+                    return None
+                if pending:
+                    idx = pending.popleft()
+                else:
+                    # Tail: duplicate a segment still in flight on another connection
+                    stragglers = [i for i, fetching in fetchers.items()
+                                  if i not in done and len(fetching) == 1 and url not in fetching]
+                    if not stragglers:
+                        return None
+                    idx = stragglers[0]
+                fetchers.setdefault(idx, set()).add(url)
+                return idx
+        
+        def worker(url):
+            while True:
+                idx = next_segment(url)
+                if idx is None:
+                    return
+                start, end = segments[idx]
+                began = time.perf_counter()
+                data = _fetch_range(url, start, end, cancelled=lambda: idx in done)
+                elapsed = time.perf_counter() - began
+                with lock:
+                    fetchers[idx].discard(url)
+                    if data is None and idx in done:
+                        # Another connection finished this segment first
+                        continue
+                    if data is None:
+                        stats[url]["failures"] += 1
+                        if idx not in done and idx not in pending and not fetchers[idx]:
+                            pending.appendleft(idx)
+                        if stats[url]["failures"] >= 3:
+                            stats[url]["retired"] = True
+                        continue
+                    stats[url]["bytes"] += len(data)
+                    stats[url]["seconds"] += elapsed
+                    first = idx not in done
+                    done.add(idx)
+                    # Stop handing work to a source far slower than the fastest one
+                    active = [u for u in sources if not stats[u]["retired"]]
+                    if len(active) > 1 and url in active and rate(url) < max(rate(u) for u in active) * slow_ratio:
+                        stats[url]["retired"] = True
+                        print(f"\033[93m⚠ Source is too slow ({rate(url) / (1024 * 1024):.2f} MB/s), moving its segments elsewhere: {url}\033[0m")
+                if first:
+                    record(idx, data, start)
+        
+        # Spread connections over the sources, best-ranked first
+        workers = [sources[i % len(sources)] for i in range(max(connections, len(sources)))]
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            list(executor.map(worker, workers))
+        
+        # A retired source may have left segments behind; finish them on any source
+        for idx in sorted(set(range(len(segments))) - done):
+            start, end = segments[idx]
+            for url in sources:
+                data = _fetch_range(url, start, end)
+                if data is not None:
+                    record(idx, data, start)
+                    done.add(idx)
+                    break
+        
+        # Hash whatever is left, e.g. a download that was entirely resumed
+        if hasher is not None and len(done) == len(segments):
+            for idx in range(hashing["next"], len(segments)):
+                hash_segment(idx)
+    finally:
+        os.close(fd)
+    
+    if len(done) != len(segments):
+        print(f"\033[91m✗ ERROR: {len(segments) - len(done)} segments could not be downloaded\033[0m")
+        return False
+    if os.path.exists(download_state_path(dest_path)):
+        os.remove(download_state_path(dest_path))
+    
+    for url in sources:
+        s = stats[url]
+        print(f"   \033[92m✓ {s['bytes'] / (1024 * 1024):.1f} MB at {rate(url) / (1024 * 1024):.2f} MB/s from {url}\033[0m")
+    return True
+
+def count_xz_blocks(path):
+    """Return the number of xz blocks in a file, or None if xz can't list it."""
+    try:
+        result = subprocess.run(["xz", "--robot", "--list", path], capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+    # Robot format: "totals\t<streams>\t<blocks>\t..."
+    for line in result.stdout.splitlines():
+        fields = line.split("\t")
+        if fields[0] == "totals" and len(fields) > 2:
+            return int(fields[2])
+    return None
+
+def xz_tar_flag(threads):
+    """Return the tar option that decompresses .xz with the given number of threads.
+
+    xz decodes independent blocks in parallel and silently falls back to a
+    single thread for single-block archives.
+    """
+    return f"--use-compress-program=xz -T{max(1, int(threads))}"
+
+def _tar_extract_command(dest_dir, threads):
+    """tar command that unpacks a .tar.xz from stdin into dest_dir, preserving permissions and xattrs."""
+    return ["tar", "xpf", "-", xz_tar_flag(threads), "--xattrs-include=*.*", "--numeric-owner", "-C", dest_dir]
+
+def _pipe_into_tar(chunks, tar_command):
+    """Feed chunks of a tarball into tar, hashing them on the way.
+
+    Returns (tar exit status, SHA512 hex, bytes fed); the status is None if the
+    input broke off before the end.
+    """
+    tar = subprocess.Popen(tar_command, stdin=subprocess.PIPE)
+    digest = hashlib.sha512()
+    received = 0
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+            tar.stdin.write(chunk)
+            received += len(chunk)
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"\033[93m⚠ WARNING: Stream interrupted after {received / (1024 * 1024):.1f} MB: {e}\033[0m")
+        tar.stdin.close()
+        tar.wait()
+        return None, digest.hexdigest(), received
+    tar.stdin.close()
+    return tar.wait(), digest.hexdigest(), received
+
+def stream_extract_tarball(urls, dest_dir, threads=1, sha512=None):
+    """Pipe a .tar.xz download straight into tar, trying each URL until one succeeds.
+
+    Uses the same tar flags as the on-disk extraction so permissions, xattrs and
+    numeric owners are preserved; the compressed tarball never touches the disk.
+    With sha512 the stream is hashed as it passes through, and a mismatch fails
+    the extraction; tar has unpacked the data by then, so a source that must be
+    rejected before extraction has to be downloaded and verified instead.
+    """
+    tar_command = _tar_extract_command(dest_dir, threads)
+    for url in urls:
+        print(f"\033[96mℹ Streaming from {url}\033[0m")
+        try:
+            with get_mirror_session(url).get(url, timeout=30, allow_redirects=True, stream=True) as response:
+                if response.status_code != 200:
+                    print(f"\033[93m⚠ WARNING: HTTP {response.status_code} from {url}\033[0m")
+                    continue
+                status, digest, received = _pipe_into_tar(response.iter_content(chunk_size=1024 * 1024), tar_command)
+                if status is None:
+                    continue
+                if sha512 and digest != sha512:
+                    # tar has already unpacked the bad data; the caller must not use dest_dir
+                    print(f"\033[91m✗ ERROR: Streamed tarball from {url} does not match its SHA512\033[0m")
+                    return False
+                if status == 0:
+                    print(f"\033[92m✓ Streamed and extracted {received / (1024 * 1024):.1f} MB\033[0m")
+                    return True
+                print(f"\033[93m⚠ WARNING: tar exited with status {status}\033[0m")
+        except requests.exceptions.RequestException as e:
+            print(f"\033[93m⚠ WARNING: Could not stream {url}: {e}\033[0m")
+    return False
+
+def parse_stage3_index(text):
+    """Return the stage3 filename listed last in a latest-stage3-*.txt index."""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    # Filter only lines that start with 'stage3-amd64'
+    stage3_lines = [line for line in lines if line.startswith("stage3-amd64")]
+    if not stage3_lines:
+        raise ValueError("No stage3 filename found in the text file.")
+    # Take the first word of the last stage3 line
+    return stage3_lines[-1].split()[0]
+
+def _load_release_cache():
+    """Load the on-disk stage3 index cache, returning {} if missing or corrupt."""
+    try:
+        with open(RELEASE_CACHE_FILE, encoding="utf-8") as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def _save_release_cache(cache):
+    """Atomically write the stage3 index cache."""
+    tmp_path = RELEASE_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, RELEASE_CACHE_FILE)
+    except OSError as e:
+        print(f"\033[93m⚠ WARNING: Could not write release cache {RELEASE_CACHE_FILE}: {e}\033[0m")
+
+def resolve_latest_stage3(index_url, timeout=30):
+    """Return the current stage3 filename from a latest-stage3-*.txt index, making at most one request.
+
+    The parsed result is cached per index URL in RELEASE_CACHE_FILE. Within
+    RELEASE_CACHE_TTL seconds the cached name is returned without touching the
+    network; after that the index is revalidated with If-None-Match /
+    If-Modified-Since, so an unchanged release costs a single 304.
+    """
+    cache = _load_release_cache()
+    entry = cache.get(index_url)
+    ttl = float(cfg_get("RELEASE_CACHE_TTL", 900))
+    if entry and time.time() - entry.get("checked", 0) < ttl:
+        return entry["filename"]
+    
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        response = requests.get(index_url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and entry:
+            entry["checked"] = time.time()
+        else:
+            response.raise_for_status()
+            entry = {
+                "filename": parse_stage3_index(response.text),
+                "etag": response.headers.get("ETag", ""),
+                "last_modified": response.headers.get("Last-Modified", ""),
+                "checked": time.time()
+            }
+    except requests.exceptions.RequestException as e:
+        if not entry:
+            raise
+        # An offline re-run can still use the last known release
+        print(f"\033[93m⚠ WARNING: Could not revalidate {index_url}, using cached release: {e}\033[0m")
+        return entry["filename"]
+    cache[index_url] = entry
+    _save_release_cache(cache)
+    return entry["filename"]
+
+def fetch_stage3_digest(base_url, filename, timeout=30):
+    """Return the SHA512 published for filename in its .DIGESTS file, or None."""
+    if not base_url.endswith('/'):
+        base_url = base_url + '/'
+    try:
+        response = requests.get(base_url + filename + ".DIGESTS", timeout=timeout)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"\033[93m⚠ WARNING: Could not fetch DIGESTS for {filename}: {e}\033[0m")
+        return None
+    
+    # Sections look like "# SHA512 HASH" followed by "<hash>  <file>" lines
+    in_sha512 = False
+    for line in response.text.splitlines():
+        line = line.strip()
+        if line.startswith("#"):
+            in_sha512 = line.upper() == "# SHA512 HASH"
+            continue
+        fields = line.split()
+        if in_sha512 and len(fields) == 2 and fields[1] == filename and re.fullmatch(r"[0-9a-fA-F]{128}", fields[0]):
+            return fields[0].lower()
+    return None
+
+def file_sha512(path):
+    """Return the hex SHA512 of a file."""
+    digest = hashlib.sha512()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ioctl(FICLONE) from linux/fs.h: share the source's extents instead of copying them
+_FICLONE = 0x40049409
+
+def copy_file_fast(src, dst):
+    """Copy src to dst, preferring a reflink, then copy_file_range, then a plain copy.
+
+    Returns the method used: "reflink", "copy_file_range" or "copy".
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            pass
+        
+        # In-kernel copy; works across filesystems on Linux 5.3+
+        if hasattr(os, "copy_file_range"):
+            remaining = os.fstat(fsrc.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(remaining, 1 << 30))
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                if remaining == 0:
+                    return "copy_file_range"
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        return "copy"
+
+class Stage3Cache:
+    """Local stage3 tarball cache keyed by filename and published SHA512.
+    
+    Entries are only added after their contents match the SHA512, and the
+    least recently used ones are evicted once the cache exceeds max_bytes.
+    """
+    
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+    
+    def path_for(self, filename, sha512):
+        return os.path.join(self.cache_dir, f"{sha512}-{filename}")
+    
+    def lookup(self, filename, sha512):
+        """Return the cached path for (filename, sha512), or None on a miss or corrupt entry."""
+        path = self.path_for(filename, sha512)
+        if not os.path.isfile(path):
+            return None
+        if file_sha512(path) != sha512:
+            print(f"\033[93m⚠ WARNING: Cached {filename} does not match its SHA512, discarding it\033[0m")
+            os.remove(path)
+            return None
+        # The modification time doubles as the LRU timestamp
+        os.utime(path)
+        return path
+    
+    def store(self, src_path, filename, sha512):
+        """Copy a verified tarball into the cache, then evict old entries. Returns the cached path or None."""
+        if not sha512:
+            return None
+        path = self.path_for(filename, sha512)
+        tmp_path = path + ".tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            copy_file_fast(src_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"\033[93m⚠ WARNING: Could not add {filename} to the stage3 cache: {e}\033[0m")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        self.evict(keep=path)
+        return path
+    
+    def entries(self):
+        """Return (mtime, size, path) for every cached tarball, oldest first."""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+    
+    def evict(self, keep=None):
+        """Remove least recently used tarballs until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            print(f"\033[96mℹ Evicted {os.path.basename(path)} from the stage3 cache\033[0m")
+
+def get_stage3_cache():
+    """Return the configured Stage3Cache, or None if STAGE3_CACHE_DIR is empty (the default).
+
+    Point STAGE3_CACHE_DIR at persistent or shared storage (a USB stick, an NFS
+    mount); on a live ISO /var/cache is tmpfs, so a cache there only fills RAM.
+    """
+    cache_dir = cfg_get("STAGE3_CACHE_DIR", "")
+    if not cache_dir:
+        return None
+    max_bytes = int(float(cfg_get("STAGE3_CACHE_MAX_GB", 10)) * 1024 ** 3)
+    return Stage3Cache(cache_dir, max_bytes)
+
+def get_lan_cache():
+    """Return the configured LAN_CACHE base URL if the cache server answers, else None."""
+    lan_cache = cfg_get("LAN_CACHE", "")
+    if not lan_cache:
+        return None
+    lan_cache = lan_cache.rstrip('/') + '/'
+    if check_mirror_reachable(lan_cache, timeout=3):
+        print(f"\033[92m✓ Using LAN cache: {lan_cache}\033[0m")
+        return lan_cache
+    print(f"\033[93m⚠ WARNING: LAN cache {lan_cache} is unreachable, downloading from the internet\033[0m")
+    return None
+
+def lan_cache_url(lan_cache, url):
+    """Rewrite a URL under a mirror's releases/ tree to fetch it through the LAN cache."""
+    path = urlparse(url).path
+    if "/releases/" not in path:
+        return url
+    return lan_cache + path[path.index("/releases/") + 1:]
+
+def stage3_index_url(url, init):
+    """Rewrite a latest-stage3-*.txt index URL to the variant for the given init system."""
+    # Universal URL handler: automatically add -systemd or -openrc before .txt based on INIT
+    # Handle the filename part (before .txt)
+    if url.endswith(".txt"):
+        # Remove any existing -systemd or -openrc before .txt
+        url = url.replace("-systemd.txt", ".txt").replace("-openrc.txt", ".txt")
+        # Add the appropriate init system suffix
+        if init == "openrc":
+            url = url.replace(".txt", "-openrc.txt")
+        else:  # systemd or unknown (default to systemd)
+            url = url.replace(".txt", "-systemd.txt")
+    
+    # Handle the directory path part
+    if init == "openrc":
+        url = url.replace("current-stage3-amd64-systemd", "current-stage3-amd64-openrc")
+        url = url.replace("current-stage3-amd64-desktop-systemd", "current-stage3-amd64-desktop-openrc")
+    else:  # systemd or unknown (default to systemd)
+        url = url.replace("current-stage3-amd64-openrc", "current-stage3-amd64-systemd")
+        url = url.replace("current-stage3-amd64-desktop-openrc", "current-stage3-amd64-desktop-systemd")
+    return url
+
+# Packages in_chroot.py emerges on top of @world; an offline bundle carries their distfiles
+INSTALL_PACKAGES = [
+    "sys-kernel/linux-firmware",
+    "sys-firmware/sof-firmware",
+    "sys-firmware/intel-microcode",
+    "sys-kernel/gentoo-kernel-bin",
+    "dev-vcs/git",
+    "sys-devel/make",
+    "net-misc/dhcpcd",
+    "app-admin/sudo",
+    "net-wireless/iw",
+    "net-wireless/wpa_supplicant",
+    "sys-boot/grub",
+]
+
+# package.license and package.use entries the INSTALL_PACKAGES need
+INSTALL_LICENSES = {
+    "sys-kernel/linux-firmware": "@BINARY-REDISTRIBUTABLE",
+    "sys-firmware/intel-microcode": "intel-ucode",
+}
+INSTALL_USE = {
+    "sys-kernel/installkernel": "systemd dracut grub",
+}
+
+def ensure_line(path, line):
+    """Append line to path unless it is already there, so re-running a step doesn't duplicate it."""
+    with _PORTAGE_CONFIG_LOCK:
+        try:
+            with open(path) as f:
+                if line in f.read().splitlines():
+                    return
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            f.write(line + "\n")
+
+class EmergePlan:
+    """A set of atoms plus the license and USE entries they need, emerged in a single resolve.
+
+    One emerge call resolves the dependency graph once and can build
+    independent packages in parallel with --jobs; with --keep-going a package
+    that fails to build only drops itself and whatever depends on it.
+    """
+
+    def __init__(self):
+        self.atoms = []
+        self.licenses = {}
+        self.use = {}
+
+    def add(self, atom, license=None, use=None):
+        """Add atom to the set, with optional package.license and package.use entries."""
+        if atom not in self.atoms:
+            self.atoms.append(atom)
+        self.configure_package(atom, license, use)
+
+    def configure_package(self, atom, license=None, use=None):
+        """Record license or USE entries for atom without adding it to the set (e.g. for a dependency)."""
+        if license:
+            self.licenses[atom] = license
+        if use:
+            self.use[atom] = use
+
+    def write_config(self, portage_dir="/etc/portage"):
+        """Write the plan's package.license and package.use entries, each at most once."""
+        for name, entries in (("package.license", self.licenses), ("package.use", self.use)):
+            path = os.path.join(portage_dir, name)
+            # Both may be a single file or a directory of files
+            if os.path.isdir(path):
+                path = os.path.join(path, "installer")
+            for atom, value in entries.items():
+                ensure_line(path, f"{atom} {value}")
+
+    def emerge_args(self, jobs=1, load_average=None):
+        """Return the emerge arguments that install the whole set in one pass."""
+        args = ["--verbose", "--noreplace", "--keep-going", f"--jobs={max(1, int(jobs))}"]
+        if load_average:
+            args.append(f"--load-average={load_average}")
+        return args + self.atoms
+
+    def missing(self):
+        """Return the atoms that are not installed, according to portageq."""
+        return [atom for atom in self.atoms
+                if subprocess.run(["portageq", "has_version", "/", atom],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0]
+
+def portageq(*args):
+    """Return the stripped output of portageq args, or "" if it fails."""
+    try:
+        return subprocess.run(["portageq", *args], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def distfile_fetch_plan(emerge_args, mirror_urls):
+    """Return [(filename, urls)] for every distfile emerge would need for emerge_args.
+
+    Uses `emerge --pretend --fetchonly`, which prints the candidate URIs of each
+    distfile on one line, mirrors first. Only files available from a mirror in
+    mirror_urls are listed; their mirror path carries the real distfile name.
+    """
+    result = subprocess.run(["emerge", "--pretend", "--fetchonly", "--quiet", *emerge_args],
+                            capture_output=True, text=True)
+    mirror_prefixes = tuple(url.rstrip('/') + '/' for url in mirror_urls)
+    plan = {}
+    for line in result.stdout.splitlines():
+        urls = line.split()
+        if not urls or not all(re.match(r"(https?|ftp)://", url) for url in urls):
+            continue
+        mirrored = [url for url in urls if url.startswith(mirror_prefixes)]
+        if mirrored:
+            plan.setdefault(os.path.basename(urlparse(mirrored[0]).path), urls)
+    return list(plan.items())
+
+def _prefetch_one(name, urls, distdir):
+    """Download one distfile from the first of urls that works. Returns True on success."""
+    dest = os.path.join(distdir, name)
+    part = os.path.join(distdir, ".prefetch", name)
+    for url in urls:
+        if not url.startswith(("http://", "https://")):
+            continue
+        try:
+            with get_mirror_session(url).get(url, stream=True, timeout=30, allow_redirects=True) as response:
+                if response.status_code != 200:
+                    continue
+                with open(part, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+        except (requests.exceptions.RequestException, OSError):
+            continue
+        # emerge may have fetched the same file meanwhile; its copy wins
+        if os.path.exists(dest):
+            os.remove(part)
+        else:
+            os.replace(part, dest)
+            try:
+                shutil.chown(dest, "portage", "portage")
+                os.chmod(dest, 0o664)
+            except (LookupError, OSError):
+                pass
+        return True
+    if os.path.exists(part):
+        os.remove(part)
+    return False
+
+def prefetch_distfiles(files, distdir, mirror_urls, connections=4):
+    """Fetch [(filename, urls)] into distdir with at most connections downloads at a time.
+
+    Files already in distdir are skipped. Successive files start on successive
+    mirrors so the connections are spread over the ranked mirrors, falling back
+    to the rest of each file's URIs. Emerge still checks every file against its
+    Manifest and re-fetches any that don't match.
+    Returns (fetched, failed) counts.
+    """
+    mirror_prefixes = tuple(url.rstrip('/') + '/' for url in mirror_urls)
+    os.makedirs(os.path.join(distdir, ".prefetch"), exist_ok=True)
+    todo = [(name, urls) for name, urls in files if not os.path.exists(os.path.join(distdir, name))]
+    
+    def ordered(index, urls):
+        mirrored = [url for url in urls if url.startswith(mirror_prefixes)]
+        if not mirrored:
+            return urls
+        shift = index % len(mirrored)
+        return mirrored[shift:] + mirrored[:shift] + [url for url in urls if url not in mirrored]
+    
+    fetched = failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, int(connections))) as executor:
+        futures = [executor.submit(_prefetch_one, name, ordered(index, urls), distdir)
+                   for index, (name, urls) in enumerate(todo)]
+        for future in as_completed(futures):
+            if future.result():
+                fetched += 1
+            else:
+                failed += 1
+    try:
+        os.rmdir(os.path.join(distdir, ".prefetch"))
+    except OSError:
+        pass
+    return fetched, failed
+
+# FEATURES each BINPKG_MODE adds to make.conf; binpkg-multi-instance keeps every build of a
+# version, so followers pick the one whose USE flags match theirs
+BINPKG_FEATURES = {
+    "builder": "buildpkg binpkg-multi-instance",
+    "follower": "getbinpkg binpkg-multi-instance",
+}
+
+def configure_binpkgs(mode, binhost="", make_conf_path="/etc/portage/make.conf"):
+    """Set up make.conf for BINPKG_MODE: builders package everything they build,
+    followers install prebuilt packages from binhost. Returns False for an unusable setup."""
+    if mode not in BINPKG_FEATURES or (mode == "follower" and not binhost):
+        return False
+    # Held across both edits so the mirror monitor's rewrite can't land in between
+    with _PORTAGE_CONFIG_LOCK:
+        ensure_line(make_conf_path, f'FEATURES="${{FEATURES}} {BINPKG_FEATURES[mode]}"')
+        if mode == "follower":
+            set_make_conf_var("PORTAGE_BINHOST", binhost, make_conf_path)
+    return True
+
+def install_plan():
+    """Return the EmergePlan for everything in_chroot.py installs on top of @world."""
+    plan = EmergePlan()
+    for atom in INSTALL_PACKAGES:
+        plan.add(atom, license=INSTALL_LICENSES.get(atom), use=INSTALL_USE.get(atom))
+    for atom, flags in INSTALL_USE.items():
+        plan.configure_package(atom, use=flags)
+    return plan
+
+# Helper sources built inside the chroot, cloned from these URLs when online
+HELPER_SOURCES = {
+    "cfstabgen": "https://codeberg.org/coast/cfstabgen.git",
+}
+
+# Offline bundle layout: manifest.json plus stage3/, snapshot/, distfiles/ and sources/
+BUNDLE_MANIFEST = "manifest.json"
+# Where the bundle is made available inside the chroot
+BUNDLE_CHROOT_PATH = "/var/cache/install-bundle"
+
+def load_bundle_manifest(bundle_path):
+    """Read the manifest of an offline bundle directory or .tar archive.
+
+    Raises ValueError if the bundle has no readable manifest.
+    """
+    try:
+        if os.path.isdir(bundle_path):
+            with open(os.path.join(bundle_path, BUNDLE_MANIFEST), encoding="utf-8") as f:
+                manifest = json.load(f)
+        else:
+            with tarfile.open(bundle_path) as tar:
+                manifest = json.load(tar.extractfile(BUNDLE_MANIFEST))
+    except (OSError, KeyError, AttributeError, tarfile.TarError, ValueError) as e:
+        raise ValueError(f"{bundle_path} is not an offline install bundle: {e}")
+    if not isinstance(manifest, dict) or "stage3" not in manifest:
+        raise ValueError(f"{bundle_path} has an incomplete bundle manifest")
+    return manifest
+
+def install_bundle_snapshot(bundle_dir, manifest, repo_dir="/var/db/repos/gentoo"):
+    """Unpack the bundle's repository snapshot into repo_dir in place of emerge-webrsync."""
+    snapshot = os.path.join(bundle_dir, "snapshot", manifest["snapshot"]["filename"])
+    os.makedirs(repo_dir, exist_ok=True)
+    # Snapshots unpack to a single top-level portage/ directory
+    return os.system(f"tar xpf '{snapshot}' '{xz_tar_flag(os.cpu_count() or 1)}' --strip-components=1 -C '{repo_dir}'") == 0
+
+def install_bundle_distfiles(bundle_dir, manifest, distdir="/var/cache/distfiles"):
+    """Copy the bundle's distfiles into distdir so emerge never needs to fetch. Returns the count copied."""
+    os.makedirs(distdir, exist_ok=True)
+    copied = 0
+    for name in manifest.get("distfiles", []):
+        dest = os.path.join(distdir, name)
+        if not os.path.exists(dest):
+            copy_file_fast(os.path.join(bundle_dir, "distfiles", name), dest)
+            copied += 1
+    return copied
+
+def helper_source_url(name, bundle_dir=None):
+    """Return where to clone a helper source from: the bundle's mirror clone when offline, else upstream."""
+    if bundle_dir:
+        return os.path.join(bundle_dir, "sources", f"{name}.git")
+    return HELPER_SOURCES[name]
+
+# Paths left out of a golden image: pseudo-filesystems, caches, installer leftovers
+# and per-host identity that the deploy regenerates
+GOLDEN_IMAGE_EXCLUDES = [
+    "./dev/*", "./proc/*", "./sys/*", "./run/*", "./tmp/*", "./var/tmp/*",
+    "./var/cache/distfiles/*", "." + BUNDLE_CHROOT_PATH,
+    "./stage3-*.tar.xz*", "./in_chroot.py", "./modules.py", "./config.jsonc", "./mirror_cache.json", "./cfstabgen",
+    "./etc/machine-id", "./etc/ssh/ssh_host_*", "./etc/fstab", "./etc/hostname",
+    "." + os.path.dirname(STEP_JOURNAL_FILE), "./var/cache/binpkgs/*",
+]
+
+# xz block size for golden images; independent blocks keep the image seekable and
+# let deploys decompress on every core
+GOLDEN_IMAGE_BLOCK = "16MiB"
+
+def capture_rootfs_image(root, image_path, threads=1):
+    """Write root as a multi-block .tar.xz image with a <image>.sha512 file next to it.
+
+    Returns the image's SHA512, or None if tar or xz failed.
+    """
+    excludes = list(GOLDEN_IMAGE_EXCLUDES)
+    image_abs = os.path.abspath(image_path)
+    if image_abs.startswith(os.path.abspath(root) + os.sep):
+        excludes.append("." + image_abs[len(os.path.abspath(root)):] + "*")
+    tar_command = ["tar", "cpf", "-", "--xattrs", "--xattrs-include=*.*", "--numeric-owner",
+                   "--one-file-system", "-C", root] + [f"--exclude={pattern}" for pattern in excludes] + ["."]
+    xz_command = ["xz", f"-T{max(1, int(threads))}", f"--block-size={GOLDEN_IMAGE_BLOCK}", "-6"]
+    
+    tmp_path = image_path + ".tmp"
+    digest = hashlib.sha512()
+    tar = subprocess.Popen(tar_command, stdout=subprocess.PIPE)
+    xz = subprocess.Popen(xz_command, stdin=tar.stdout, stdout=subprocess.PIPE)
+    tar.stdout.close()
+    with open(tmp_path, "wb") as f:
+        for chunk in iter(lambda: xz.stdout.read(1024 * 1024), b""):
+            digest.update(chunk)
+            f.write(chunk)
+    xz.wait()
+    tar.wait()
+    # tar exits 1 when a file changed while being read, which a live log file may do
+    if tar.returncode not in (0, 1) or xz.returncode != 0:
+        print(f"\033[91m✗ ERROR: Image capture failed (tar {tar.returncode}, xz {xz.returncode})\033[0m")
+        os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, image_path)
+    with open(image_path + ".sha512", "w") as f:
+        f.write(f"{digest.hexdigest()}  {os.path.basename(image_path)}\n")
+    return digest.hexdigest()
+
+def fetch_image_digest(source):
+    """Return the SHA512 recorded in <source>.sha512 for a local or http(s) image, or None."""
+    try:
+        if source.startswith(("http://", "https://")):
+            response = requests.get(source + ".sha512", timeout=30)
+            response.raise_for_status()
+            text = response.text
         else:
-            print(f"\033[91m✗ ERROR: Could not find a working mirror!\033[0m")
+            with open(source + ".sha512", encoding="utf-8") as f:
+                text = f.read()
+        return text.split()[0].lower()
+    except (requests.exceptions.RequestException, OSError, IndexError):
+        return None
+
+def deploy_rootfs_image(source, dest_dir, threads=1, sha512=None):
+    """Unpack a golden image from a local path or http(s) URL into dest_dir, verifying sha512 on the way."""
+    if source.startswith(("http://", "https://")):
+        return stream_extract_tarball([source], dest_dir, threads, sha512)
+    with open(source, "rb") as f:
+        status, digest, received = _pipe_into_tar(iter(lambda: f.read(1024 * 1024), b""), _tar_extract_command(dest_dir, threads))
+    if sha512 and digest != sha512:
+        print(f"\033[91m✗ ERROR: Golden image {source} does not match its SHA512\033[0m")
+        return False
+    if status != 0:
+        print(f"\033[93m⚠ WARNING: tar exited with status {status}\033[0m")
+        return False
+    print(f"\033[92m✓ Deployed {received / (1024 * 1024):.1f} MB image\033[0m")
+    return True
+
+def _step_digest(value):
+    """Return a stable hash of a step's JSON-serializable inputs."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+def _output_digest(path):
+    """Return the SHA512 of an output file, or None if it no longer exists."""
+    return file_sha512(path) if os.path.isfile(path) else None
+
+class StepJournal:
+    """Persistent record of completed install steps, their inputs and output file hashes.
+
+    A step is skipped on a later run when it completed with the same inputs,
+    after every step it depends on last completed, and every output file it
+    recorded still hashes the same. Inputs are stored as one unsalted hash
+    that stays on the installed system, so secrets such as passwords must never
+    be step inputs.
+    """
+
+    def __init__(self, path=STEP_JOURNAL_FILE):
+        self.path = path
+        self.steps = {}
+        # Steps of an install graph finish on worker threads
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                steps = json.load(f).get("steps", {})
+            if isinstance(steps, dict):
+                self.steps = steps
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def save(self):
+        """Atomically write the journal, readable by root only."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"steps": self.steps}, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"\033[93m⚠ WARNING: Could not write step journal {self.path}: {e}\033[0m")
+
+    def is_complete(self, name, inputs, deps=()):
+        """Return True if name completed with these inputs, after its deps, and its outputs are untouched."""
+        entry = self.steps.get(name)
+        if not entry or entry.get("inputs") != _step_digest(inputs):
+            return False
+        # A dependency that re-ran since this step completed invalidates it
+        for dep in deps:
+            if dep not in self.steps or self.steps[dep].get("completed", 0) > entry.get("completed", 0):
+                return False
+        return all(_output_digest(path) == digest for path, digest in entry.get("outputs", {}).items())
+
+    def record(self, name, inputs, outputs=(), result=True):
+        """Mark name complete, hashing its output files as they are now."""
+        entry = {
+            "inputs": _step_digest(inputs),
+            "outputs": {path: _output_digest(path) for path in outputs},
+            "result": result,
+            "completed": time.time()
+        }
+        with self.lock:
+            self.steps[name] = entry
+            self.save()
+
+    def run(self, name, func, inputs=None, outputs=(), deps=(), always=False):
+        """Run func() unless name is already complete, recording it if it succeeds.
+
+        func returns a falsy value on failure, otherwise a JSON-serializable
+        result that is stored and handed back again when the step is skipped.
+        Steps with always set are never skipped, only recorded.
+        Returns the result, or None if the step failed.
+        """
+        inputs = inputs or {}
+        if not always and self.is_complete(name, inputs, deps):
+            print(f"\033[92m✓ Step '{name}' already completed, skipping\033[0m")
+            return self.steps[name].get("result", True)
+        result = func()
+        if not result:
             return None
+        self.record(name, inputs, outputs, result)
+        return result
+
+class InstallStep:
+    """A journaled install step with the steps it depends on and the resources it holds while running.
+
+    Steps sharing a lock name (e.g. "portage" for anything that runs emerge)
+    never run at the same time. Cheap steps whose real inputs are secret set
+    always and run every time instead of being journaled by those inputs;
+    a step that re-runs also re-runs everything that depends on it.
+    """
+
+    def __init__(self, name, func, deps=(), locks=(), inputs=None, outputs=(), always=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.locks = set(locks)
+        self.inputs = inputs or {}
+        self.outputs = list(outputs)
+        self.always = always
+
+def run_step_graph(steps, journal, max_workers=4, on_complete=None):
+    """Run InstallSteps through journal as soon as their dependencies and locks allow.
+
+    Ready steps start in list order, so steps contending for a lock keep the
+    order they were listed in. on_complete(name, result) is called on the
+    calling thread as each step finishes. After a failure no new steps start,
+    but running ones are allowed to finish.
+    Returns (results, failed): results of the completed steps by name, and the
+    names of the steps that failed.
+    """
+    names = {step.name for step in steps}
+    for step in steps:
+        missing = [dep for dep in step.deps if dep not in names]
+        if missing:
+            raise ValueError(f"Step {step.name} depends on unknown steps: {', '.join(missing)}")
+    
+    max_workers = max(1, int(max_workers))
+    pending = list(steps)
+    running = {}
+    held = set()
+    results = {}
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if not failed:
+                for step in list(pending):
+                    if len(running) >= max_workers:
+                        break
+                    if all(dep in results for dep in step.deps) and not held & step.locks:
+                        pending.remove(step)
+                        held |= step.locks
+                        future = executor.submit(journal.run, step.name, step.func, step.inputs, step.outputs,
+                                                 step.deps, step.always)
+                        running[future] = step
+            if not running:
+                # Whatever is left waits on a failed step (or a dependency cycle)
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                held -= step.locks
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"\033[91m✗ ERROR: Step '{step.name}' raised {type(e).__name__}: {e}\033[0m")
+                    result = None
+                if result is None:
+                    failed.append(step.name)
+                    continue
+                results[step.name] = result
+                if on_complete:
+                    on_complete(step.name, result)
+    return results, failed
 
 DEFAULT_CONFIG = {
 
@@ -583,7 +2541,47 @@ DEFAULT_CONFIG = {
     "MAKEOPTS_L": 3,
     "INIT": "systemd",
     "URL": "https://gentoo.osuosl.org/releases/amd64/autobuilds/current-stage3-amd64-systemd/latest-stage3-amd64-systemd.txt",
+    "STAGE3_DOWNLOAD": "segmented",
+    "STAGE3_EXTRACT": "file",
+    "XZ_THREADS": 0,
+    "RELEASE_CACHE_TTL": 900,
+    "OFFLINE_BUNDLE": "",
+    "LAN_CACHE": "",
+    "GOLDEN_CAPTURE": "",
+    "GOLDEN_DEPLOY": "",
+    "PARALLEL_STEPS": 4,
+    "EMERGE_JOBS": 4,
+    "PREFETCH_CONNECTIONS": 4,
+    "BINPKG_MODE": "",
+    "BINHOST": "",
+    "BINPKG_PUBLISH_DIR": "",
+    "STAGE3_CACHE_DIR": "",
+    "STAGE3_CACHE_MAX_GB": 10,
+    "DOWNLOAD_CONNECTIONS": 8,
+    "DOWNLOAD_SEGMENT_MB": 8,
+    "DOWNLOAD_SLOW_RATIO": 0.25,
     "MIRROR":"sahur",
+    "MIRROR_FAILOVER": [],
+    "MIRROR_FAILOVER_COUNT": 3,
+    "MIRROR_LIST_FILE": "",
+    "MIRROR_MONITOR": False,
+    "MIRROR_MONITOR_INTERVAL": 300,
+    "MIRROR_MONITOR_THRESHOLD": 0.3,
+    "MIRROR_CONCURRENCY": 16,
+    "MIRROR_DEADLINE": 60,
+    "MIRROR_CACHE_TTL": 21600,
+    "MIRROR_GEO_PREFILTER": True,
+    "MIRROR_GEO_NEARBY": 15,
+    "MIRROR_GEO_MAX_SCORE": 150,
+    "MIRROR_SAMPLING": "fixed",
+    "MIRROR_TOURNAMENT_KEEP": 0.5,
+    "MIRROR_TOURNAMENT_SAMPLES": 2,
+    "MIRROR_TOURNAMENT_MAX_SAMPLES": 9,
+    "MIRROR_RANKING": "latency",
+    "MIRROR_THROUGHPUT_FINALISTS": 5,
+    "MIRROR_THROUGHPUT_PATH": "snapshots/portage-latest.tar.xz",
+    "MIRROR_THROUGHPUT_BYTES": 4194304,
+    "MIRROR_THROUGHPUT_SECONDS": 5,
     "PROFILE": 2,
     "ZONEINFO": "Europe/Bucharest",
     "LOCALE": 1,